@@ -1,8 +1,39 @@
+import bz2
+import calendar
+import codecs
+import gzip
+import io
+import mmap
+import os
 import re
+import threading
+import time
+from array import array
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:
+    from inspect import getargspec
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 from datetime import datetime, tzinfo, timedelta
+from functools import partial
+from itertools import chain
 
 import user_agents
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class ApacheLogParserException(Exception): pass
 
 class LineDoesntMatchException(ApacheLogParserException):
@@ -35,26 +66,122 @@ def make_regex(format_template):
     percent, rest = format_template[0], format_template[1:]
     return percent+"[<>]?"+rest
 
+def identity(matched_strings):
+    """Post processor for fields that are returned as they are"""
+    return matched_strings
+
+REQUEST_METHOD_REGEX = re.compile("(?P<method>GET|HEAD|POST|OPTIONS|PUT|CONNECT|PATCH|PROPFIND|DELETE)\\s?")
+
+HTTP_VERSION_REGEX = re.compile("HTTP/(?P<http_ver>1.[01])$")
+
+MAX_URL_LENGTH = 10000
+
 def extra_request_from_first_line(matched_strings):
     first_line = matched_strings['request_first_line']
-    match = re.match("^(?P<method>GET|HEAD|POST|OPTIONS|PUT|CONNECT|PATCH|PROPFIND|DELETE)\s?(?P<url>.{,10000}?)(\s+HTTP/(?P<http_ver>1.[01]))?$", first_line)
+    # Same as matching "^(?P<method>...)\s?(?P<url>.{,10000}?)(\s+HTTP/(?P<http_ver>1.[01]))?$",
+    # without the regex backtracking over long URLs & runs of spaces
+    match = REQUEST_METHOD_REGEX.match(first_line)
+    url = http_ver = None
+    if match is not None:
+        rest = first_line[match.end():]
+        if rest.endswith("\n"):
+            # $ matches before a newline at the end
+            rest = rest[:-1]
+        if len(rest) > 8 and HTTP_VERSION_REGEX.match(rest, len(rest) - 8):
+            url = rest[:-8].rstrip()
+            if len(url) < len(rest) - 8:
+                http_ver = rest[-3:]
+            else:
+                # No space before the HTTP/1.x
+                url = None
+        if url is None:
+            url = rest
+        if len(url) > MAX_URL_LENGTH or "\n" in url:
+            match = None
     if match is None:
         # Possibly garbage, ignore it
         results = { 'request_first_line': first_line, 'request_method': '', 'request_url': '', 'request_http_ver': ''}
     else:
-        results = { 'request_first_line': first_line, 'request_method': match.groupdict()['method'], 'request_url': match.groupdict()['url'], 'request_http_ver': match.groupdict()['http_ver']}
+        results = { 'request_first_line': first_line, 'request_method': match.group('method'), 'request_url': url, 'request_http_ver': http_ver}
     return results
 
-def parse_user_agent(matched_strings):
-    ua = matched_strings['request_header_user_agent']
+REQUEST_FIRST_LINE_FIELDS = ('request_first_line', 'request_method', 'request_url', 'request_http_ver')
+
+USER_AGENT_FIELDS = (
+    ('__browser__family', lambda parsed_ua: parsed_ua.browser.family),
+    ('__browser__version_string', lambda parsed_ua: parsed_ua.browser.version_string),
+    ('__os__family', lambda parsed_ua: parsed_ua.os.family),
+    ('__os__version_string', lambda parsed_ua: parsed_ua.os.version_string),
+    ('__is_mobile', lambda parsed_ua: parsed_ua.is_mobile),
+)
+
+DEFAULT_USER_AGENT_CACHE_SIZE = 1024
+
+class UserAgentCache(object):
+    """
+    Bounded LRU memo of parsed User-Agent fields, keyed on the raw User-Agent
+    string. Each entry is a tuple of (key, value) pairs, so a cached result
+    can't be changed by whoever receives it. It can be used from several
+    threads at once (a Parser from get_parser may be shared between them).
+    """
+
+    def __init__(self, maxsize=DEFAULT_USER_AGENT_CACHE_SIZE):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, not {0!r}".format(maxsize))
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, ua):
+        """Return the (key, value) pairs for this User-Agent, parsing it on a miss"""
+        entries = self._entries
+        with self._lock:
+            fields = entries.pop(ua, None)
+            if fields is not None:
+                self.hits += 1
+                entries[ua] = fields
+                return fields
+        # Parsed without holding the lock, as that's the slow part
+        fields = _user_agent_fields(ua)
+        with self._lock:
+            self.misses += 1
+            # Another thread may have added it in the meantime
+            if entries.pop(ua, None) is None and len(entries) >= self.maxsize:
+                entries.popitem(last=False)
+                self.evictions += 1
+            entries[ua] = fields
+        return fields
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self._entries), 'maxsize': self.maxsize}
+
+    def clear(self):
+        """Drop all entries and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+USER_AGENT_FIELDNAMES = ('request_header_user_agent',) + tuple('request_header_user_agent'+suffix for suffix, getter in USER_AGENT_FIELDS)
+
+def _user_agent_fields(ua):
     parsed_ua = user_agents.parse(ua)
-    matched_strings.update({
-        'request_header_user_agent__browser__family': parsed_ua.browser.family,
-        'request_header_user_agent__browser__version_string': parsed_ua.browser.version_string,
-        'request_header_user_agent__os__family': parsed_ua.os.family,
-        'request_header_user_agent__os__version_string': parsed_ua.os.version_string,
-        'request_header_user_agent__is_mobile': parsed_ua.is_mobile,
-    })
+    return tuple(('request_header_user_agent'+suffix, getter(parsed_ua)) for suffix, getter in USER_AGENT_FIELDS)
+
+def parse_user_agent(matched_strings, cache=None):
+    ua = matched_strings['request_header_user_agent']
+    if cache is None:
+        fields = _user_agent_fields(ua)
+    else:
+        fields = cache.get(ua)
+    matched_strings.update(fields)
 
     return matched_strings
 
@@ -63,6 +190,7 @@ class FixedOffset(tzinfo):
 
     def __init__(self, string):
         #import pudb ; pudb.set_trace()
+        self.__string = string
         if string[0] == '-':
             direction = -1
             string = string[1:]
@@ -94,146 +222,1647 @@ class FixedOffset(tzinfo):
     def __repr__(self):
         return repr(self.__name)
 
+    def __reduce__(self):
+        # So that it can be pickled, e.g. to send results between processes
+        return (fixed_offset, (self.__string,))
+
+
+MONTH_MAP = {'Jan': 1, 'Feb': 2, 'Mar':3, 'Apr':4, 'May':5, 'Jun':6, 'Jul':7,
+    'Aug':8,  'Sep': 9, 'Oct':10, 'Nov': 11, 'Dec': 12}
+
+UTC = FixedOffset('0000')
+
+_fixed_offsets = {}
+
+def fixed_offset(string):
+    """
+    Return the FixedOffset for this timezone offset string (e.g. "+0100"). One
+    instance is shared for each offset, rather than creating one per line
+    """
+    try:
+        return _fixed_offsets[string]
+    except KeyError:
+        if len(_fixed_offsets) >= 1000:
+            # Only garbage input would have this many offsets
+            _fixed_offsets.clear()
+        tz = _fixed_offsets[string] = FixedOffset(string)
+        return tz
 
 def apachetime(s):
     """
     Given a string representation of a datetime in apache format (e.g.
     "01/Sep/2012:06:05:11 +0000"), return the python datetime for that string, with timezone
     """
-    month_map = {'Jan': 1, 'Feb': 2, 'Mar':3, 'Apr':4, 'May':5, 'Jun':6, 'Jul':7,
-        'Aug':8,  'Sep': 9, 'Oct':10, 'Nov': 11, 'Dec': 12}
     s = s[1:-1]
 
-    tz_string = s[21:26]
-    tz = FixedOffset(tz_string)
+    tz = fixed_offset(s[21:26])
 
-    obj = datetime(year=int(s[7:11]), month=month_map[s[3:6]], day=int(s[0:2]),
-                hour=int(s[12:14]), minute=int(s[15:17]), second=int(s[18:20]),
-                tzinfo=tz )
+    obj = datetime(int(s[7:11]), MONTH_MAP[s[3:6]], int(s[0:2]),
+                int(s[12:14]), int(s[15:17]), int(s[18:20]), 0, tz)
 
     return obj
 
-def format_time(matched_strings):
-
-    time_received = matched_strings['time_received']
-
+def _time_fields(time_received):
     # Parse it to a timezone string
     obj = apachetime(time_received)
-    
+
     # For backwards compatibility, time_received_datetimeobj is a naive
     # datetime, so we have to create a timezone less version
     naive_obj = obj.replace(tzinfo=None)
 
-    utc = FixedOffset('0000')
-    utc_obj = obj.astimezone(utc)
+    utc_obj = obj.astimezone(UTC)
+
+    return (
+        ('time_received', time_received),
+        ('time_received_datetimeobj', naive_obj), ('time_received_isoformat', naive_obj.isoformat()),
+        ('time_received_tz_datetimeobj', obj), ('time_received_tz_isoformat', obj.isoformat()),
+        ('time_received_utc_datetimeobj', utc_obj), ('time_received_utc_isoformat', utc_obj.isoformat()),
+    )
+
+TIME_FIELDS = tuple(key for key, value in _time_fields('[01/Jan/2000:00:00:00 +0000]'))
 
-    return {
-        'time_received':time_received,
-        'time_received_datetimeobj': naive_obj, 'time_received_isoformat': naive_obj.isoformat(),
-        'time_received_tz_datetimeobj': obj, 'time_received_tz_isoformat': obj.isoformat(),
-        'time_received_utc_datetimeobj': utc_obj, 'time_received_utc_isoformat': utc_obj.isoformat(),
-    }
+DEFAULT_TIME_CACHE_SIZE = 128
+
+class TimeCache(object):
+    """
+    Memo of the decoded time fields for recently seen %t strings. Lines are
+    logged in time order, so most lookups are for the same second as the
+    line before, and that is checked first. Otherwise up to ``maxsize``
+    timestamps are kept, and the lot is dropped when it's full. Like
+    UserAgentCache, entries are tuples of (key, value) pairs.
+    """
+
+    def __init__(self, maxsize=DEFAULT_TIME_CACHE_SIZE):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, not {0!r}".format(maxsize))
+        self.maxsize = maxsize
+        self._entries = {}
+        self._last = (None, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, time_received):
+        """Return the (key, value) pairs for this %t string, decoding it on a miss"""
+        last_time_received, fields = self._last
+        if time_received == last_time_received:
+            return fields
+        entries = self._entries
+        fields = entries.get(time_received)
+        if fields is None:
+            fields = _time_fields(time_received)
+            if len(entries) >= self.maxsize:
+                entries.clear()
+            entries[time_received] = fields
+        self._last = (time_received, fields)
+        return fields
+
+    def clear(self):
+        self._entries.clear()
+        self._last = (None, None)
+
+def format_time(matched_strings, cache=None):
+
+    time_received = matched_strings['time_received']
+
+    if cache is None:
+        fields = _time_fields(time_received)
+    else:
+        fields = cache.get(time_received)
+
+    return dict(fields)
 
 IPv4_ADDR_REGEX = '(?:\d{1,3}\.){3}\d{1,3}'
 IPv6_ADDR_REGEX = "([0-9A-Fa-f]{0,4}:){2,7}([0-9A-Fa-f]{0,4})"
 IP_ADDR_REGEX = "("+IPv4_ADDR_REGEX+"|"+IPv6_ADDR_REGEX+")"
 
+# Matches a field inside double quotes, where apache has escaped any " or \ in
+# the value with a \
+QUOTED_FIELD_REGEX = r'[^"\\\n]*(?:\\.[^"\\\n]*)*'
+
+# A field in double quotes, where {0} is a regex for what comes after its
+# closing quote. Apache escapes " and \ in them, but older versions and
+# other servers don't always, so an unescaped " that isn't followed by that,
+# or a lone \ just before the closing quote, is allowed too.
+# Each character can only be matched one way unless it's a \ before what
+# could be the closing quote, so backtracking is only needed for those. So
+# an unescaped " followed by that text is always taken as the closing quote:
+# lines where it isn't, that ".*?" matched, don't match this.
+DELIMITED_FIELD_REGEX = r'[^"\\\n]*(?:(?:\\.|\\(?="{0})|"(?!{0}))[^"\\\n]*)*'
+
+# The same for the last field in the format, which ends at the first " that
+# can close it. The line regex only has to match the start of the line, so
+# that's the first unescaped " (as it was with ".*?"), or with a lone \ before
+# it. An unescaped " is only taken as part of the field if the regex is
+# anchored at the end of the line and can't match otherwise.
+LAST_QUOTED_FIELD_REGEX = r'[^"\\\n]*(?:(?:\\.|\\(?="(?![^\r\n]))|"(?=[^\r\n]))[^"\\\n]*)*?'
+
+# Directives whose values never have whitespace in them
+TOKEN_DIRECTIVES = 'hlpPkmHvVXTIOR'
+
+def tighten_field_regex(log_part_regex, directive, following, at_end=False):
+    """
+    Given the regex for a field, the directive it's for (e.g. "%h") and the
+    literal text after it in the format string, return a regex for the field
+    which doesn't need backtracking where that's safe. e.g. a field in double
+    quotes goes up to the first " that's followed by the rest of that text
+    (or the first one that can close it if ``at_end``, it's the last field), and
+    %h, followed by a space, can't have whitespace in it. Otherwise the regex
+    is returned as it is.
+    """
+    if log_part_regex != '.*?' or not following:
+        return log_part_regex
+    if following[0] == '"':
+        if len(following) > 1:
+            return DELIMITED_FIELD_REGEX.format(re.escape(following[1:]))
+        if at_end:
+            return LAST_QUOTED_FIELD_REGEX
+        # Another field straight after the quote, so nothing to tell an
+        # unescaped " from the closing one
+        return QUOTED_FIELD_REGEX
+    if following[0] in ' \t' and directive[-1] in TOKEN_DIRECTIVES:
+        return '\\S*'
+    return log_part_regex
+
 FORMAT_STRINGS = [
-    ['%%', '%', lambda match: '', lambda matched_strings: matched_strings],
-    [make_regex('%a'), IP_ADDR_REGEX, lambda match: 'remote_ip', lambda matched_strings: matched_strings], #	Remote IP-address
-    [make_regex('%A'), IP_ADDR_REGEX, lambda match: 'local_ip', lambda matched_strings: matched_strings], #	Local IP-address
-    [make_regex('%B'), '(\d+|-)', lambda match: 'response_bytes', lambda matched_strings: matched_strings], #	Size of response in bytes, excluding HTTP headers.
-    [make_regex('%b'), '(\d+|-)', lambda match: 'response_bytes_clf', lambda matched_strings: matched_strings], #	Size of response in bytes, excluding HTTP headers. In CLF format, i.e. a '-' rather than a 0 when no bytes are sent.
-    [make_regex('%\{[^\}]+?\}C'), '.*?', extract_inner_value("cookie_", "C") , lambda matched_strings: matched_strings], #	The contents of cookie Foobar in the request sent to the server. Only version 0 cookies are fully supported.
-    [make_regex('%D'), '-?\d+', lambda match: 'time_us', lambda matched_strings: matched_strings], #	The time taken to serve the request, in microseconds.
-    [make_regex('%\{[^\}]+?\}e'), '.*?', extract_inner_value("env_", "e"), lambda matched_strings: matched_strings], #	The contents of the environment variable FOOBAR
-    [make_regex('%f'), '.*?', lambda match: 'filename', lambda matched_strings: matched_strings], #	Filename
-    [make_regex('%h'), '.*?', lambda match: 'remote_host', lambda matched_strings: matched_strings], #	Remote host
-    [make_regex('%H'), '.*?', lambda match: 'protocol', lambda matched_strings: matched_strings], #	The request protocol
+    ['%%', '%', lambda match: '', identity],
+    [make_regex('%a'), IP_ADDR_REGEX, lambda match: 'remote_ip', identity], #	Remote IP-address
+    [make_regex('%A'), IP_ADDR_REGEX, lambda match: 'local_ip', identity], #	Local IP-address
+    [make_regex('%B'), '(\d+|-)', lambda match: 'response_bytes', identity], #	Size of response in bytes, excluding HTTP headers.
+    [make_regex('%b'), '(\d+|-)', lambda match: 'response_bytes_clf', identity], #	Size of response in bytes, excluding HTTP headers. In CLF format, i.e. a '-' rather than a 0 when no bytes are sent.
+    [make_regex('%\{[^\}]+?\}C'), '.*?', extract_inner_value("cookie_", "C") , identity], #	The contents of cookie Foobar in the request sent to the server. Only version 0 cookies are fully supported.
+    [make_regex('%D'), '-?\d+', lambda match: 'time_us', identity], #	The time taken to serve the request, in microseconds.
+    [make_regex('%\{[^\}]+?\}e'), '.*?', extract_inner_value("env_", "e"), identity], #	The contents of the environment variable FOOBAR
+    [make_regex('%f'), '.*?', lambda match: 'filename', identity], #	Filename
+    [make_regex('%h'), '.*?', lambda match: 'remote_host', identity], #	Remote host
+    [make_regex('%H'), '.*?', lambda match: 'protocol', identity], #	The request protocol
 
     # Special case of below, for matching just user agent
     [make_regex('%\{User-Agent\}i'), '.*?', lambda match: "request_header_user_agent" , parse_user_agent],
-    [make_regex('%\{[^\}]+?\}i'), '.*?', extract_inner_value("request_header_", "i") , lambda matched_strings: matched_strings], #	The contents of Foobar: header line(s) in the request sent to the server. Changes made by other modules (e.g. mod_headers) affect this. If you're interested in what the request header was prior to when most modules would have modified it, use mod_setenvif to copy the header into an internal environment variable and log that value with the %\{VARNAME}e described above.
-
-    [make_regex('%k'), '.*?', lambda match: 'num_keepalives', lambda matched_strings: matched_strings], #	Number of keepalive requests handled on this connection. Interesting if KeepAlive is being used, so that, for example, a '1' means the first keepalive request after the initial one, '2' the second, etc...; otherwise this is always 0 (indicating the initial request). Available in versions 2.2.11 and later.
-    [make_regex('%l'), '.*?', lambda match: 'remote_logname', lambda matched_strings: matched_strings], #	Remote logname (from identd, if supplied). This will return a dash unless mod_ident is present and IdentityCheck is set On.
-    [make_regex('%m'), '.*?', lambda match: 'method', lambda matched_strings: matched_strings], #	The request method
-    [make_regex('%\{[^\}]+?\}n'), '.*?', extract_inner_value("note_", "n") , lambda matched_strings: matched_strings], #	The contents of note Foobar from another module.
-    [make_regex('%\{[^\}]+?\}o'), '.*?',extract_inner_value("response_header_", "o") , lambda matched_strings: matched_strings], #	The contents of Foobar: header line(s) in the reply.
-    [make_regex('%p'), '.*?', lambda match: 'server_port', lambda matched_strings: matched_strings], #	The canonical port of the server serving the request
-    [make_regex('%\{[^\}]+?\}p'), '.*?', extract_inner_value("server_port_", "p") , lambda matched_strings: matched_strings], #	The canonical port of the server serving the request or the server's actual port or the client's actual port. Valid formats are canonical, local, or remote.
-    [make_regex('%P'), '.*?', lambda match: 'pid', lambda matched_strings: matched_strings], #	The process ID of the child that serviced the request.
-    [make_regex('%\{[^\}]+?\}P'), '.*?', extract_inner_value("pid_", "P") , lambda matched_strings: matched_strings], #	The process ID or thread id of the child that serviced the request. Valid formats are pid, tid, and hextid. hextid requires APR 1.2.0 or higher.
-    [make_regex('%q'), '.*?', lambda match: 'query_string' , lambda matched_strings: matched_strings], #	The query string (prepended with a ? if a query string exists, otherwise an empty string)
+    [make_regex('%\{[^\}]+?\}i'), '.*?', extract_inner_value("request_header_", "i") , identity], #	The contents of Foobar: header line(s) in the request sent to the server. Changes made by other modules (e.g. mod_headers) affect this. If you're interested in what the request header was prior to when most modules would have modified it, use mod_setenvif to copy the header into an internal environment variable and log that value with the %\{VARNAME}e described above.
+
+    [make_regex('%k'), '.*?', lambda match: 'num_keepalives', identity], #	Number of keepalive requests handled on this connection. Interesting if KeepAlive is being used, so that, for example, a '1' means the first keepalive request after the initial one, '2' the second, etc...; otherwise this is always 0 (indicating the initial request). Available in versions 2.2.11 and later.
+    [make_regex('%l'), '.*?', lambda match: 'remote_logname', identity], #	Remote logname (from identd, if supplied). This will return a dash unless mod_ident is present and IdentityCheck is set On.
+    [make_regex('%m'), '.*?', lambda match: 'method', identity], #	The request method
+    [make_regex('%\{[^\}]+?\}n'), '.*?', extract_inner_value("note_", "n") , identity], #	The contents of note Foobar from another module.
+    [make_regex('%\{[^\}]+?\}o'), '.*?',extract_inner_value("response_header_", "o") , identity], #	The contents of Foobar: header line(s) in the reply.
+    [make_regex('%p'), '.*?', lambda match: 'server_port', identity], #	The canonical port of the server serving the request
+    [make_regex('%\{[^\}]+?\}p'), '.*?', extract_inner_value("server_port_", "p") , identity], #	The canonical port of the server serving the request or the server's actual port or the client's actual port. Valid formats are canonical, local, or remote.
+    [make_regex('%P'), '.*?', lambda match: 'pid', identity], #	The process ID of the child that serviced the request.
+    [make_regex('%\{[^\}]+?\}P'), '.*?', extract_inner_value("pid_", "P") , identity], #	The process ID or thread id of the child that serviced the request. Valid formats are pid, tid, and hextid. hextid requires APR 1.2.0 or higher.
+    [make_regex('%q'), '.*?', lambda match: 'query_string' , identity], #	The query string (prepended with a ? if a query string exists, otherwise an empty string)
     [make_regex('%r'), '.*?', lambda match: 'request_first_line', extra_request_from_first_line], #	First line of request
-    [make_regex('%R'), '.*?', lambda match: 'handler', lambda matched_strings: matched_strings], #	The handler generating the response (if any).
-    [make_regex('%s'), '([0-9]+?|-)', lambda match: 'status', lambda matched_strings: matched_strings], #	Status. For requests that got internally redirected, this is the status of the *original* request --- %>s for the last.
-    [make_regex('%t'), '\[.*?\]', lambda match: 'time_received', format_time], #	Time the request was received (standard english format)
-    [make_regex('%\{[^\}]+?\}t'), '.*?', extract_inner_value("time_", "t") , lambda matched_strings: matched_strings], #	The time, in the form given by format, which should be in strftime(3) format. (potentially localized)
-    [make_regex('%\{[^\}]+?\}x'), '.*?', extract_inner_value("extension_", "x") , lambda matched_strings: matched_strings], # Extension value, e.g. mod_ssl protocol and cipher
-    [make_regex('%T'), '.*?', lambda match: 'time_s', lambda matched_strings: matched_strings], #	The time taken to serve the request, in seconds.
-    [make_regex('%u'), '.*?', lambda match: 'remote_user', lambda matched_strings: matched_strings], #	Remote user (from auth; may be bogus if return status (%s) is 401)
-    [make_regex('%U'), '.*?', lambda match: 'url_path' , lambda matched_strings: matched_strings], #	The URL path requested, not including any query string.
-    [make_regex('%v'), '.*?', lambda match: 'server_name', lambda matched_strings: matched_strings], #	The canonical ServerName of the server serving the request.
-    [make_regex('%V'), '.*?', lambda match: 'server_name2', lambda matched_strings: matched_strings], #	The server name according to the UseCanonicalName setting.
-    [make_regex('%X'), '.*?', lambda match: 'conn_status', lambda matched_strings: matched_strings], #	Connection status when response is completed:
+    [make_regex('%R'), '.*?', lambda match: 'handler', identity], #	The handler generating the response (if any).
+    [make_regex('%s'), '([0-9]+?|-)', lambda match: 'status', identity], #	Status. For requests that got internally redirected, this is the status of the *original* request --- %>s for the last.
+    [make_regex('%t'), '\[[^\]\n]*\]', lambda match: 'time_received', format_time], #	Time the request was received (standard english format)
+    [make_regex('%\{[^\}]+?\}t'), '.*?', extract_inner_value("time_", "t") , identity], #	The time, in the form given by format, which should be in strftime(3) format. (potentially localized)
+    [make_regex('%\{[^\}]+?\}x'), '.*?', extract_inner_value("extension_", "x") , identity], # Extension value, e.g. mod_ssl protocol and cipher
+    [make_regex('%T'), '.*?', lambda match: 'time_s', identity], #	The time taken to serve the request, in seconds.
+    [make_regex('%u'), '.*?', lambda match: 'remote_user', identity], #	Remote user (from auth; may be bogus if return status (%s) is 401)
+    [make_regex('%U'), '.*?', lambda match: 'url_path' , identity], #	The URL path requested, not including any query string.
+    [make_regex('%v'), '.*?', lambda match: 'server_name', identity], #	The canonical ServerName of the server serving the request.
+    [make_regex('%V'), '.*?', lambda match: 'server_name2', identity], #	The server name according to the UseCanonicalName setting.
+    [make_regex('%X'), '.*?', lambda match: 'conn_status', identity], #	Connection status when response is completed:
         # X =	connection aborted before the response completed.
         # + =	connection may be kept alive after the response is sent.
         # - =	connection will be closed after the response is sent.
         # (This directive was %c in late versions of Apache 1.3, but this conflicted with the historical ssl %{var}c syntax.)
-    [make_regex('%I'), '.*?', lambda match: 'bytes_rx', lambda matched_strings: matched_strings], #	Bytes received, including request and headers, cannot be zero. You need to enable mod_logio to use this.
-    [make_regex('%O'), '.*?', lambda match: 'bytes_tx', lambda matched_strings: matched_strings], #	Bytes sent, including headers, cannot be zero. You need to enable mod_logio to use this.
+    [make_regex('%I'), '.*?', lambda match: 'bytes_rx', identity], #	Bytes received, including request and headers, cannot be zero. You need to enable mod_logio to use this.
+    [make_regex('%O'), '.*?', lambda match: 'bytes_tx', identity], #	Bytes sent, including headers, cannot be zero. You need to enable mod_logio to use this.
 ]
 
+# The keys each post processor adds to the results. Post processors always
+# pass the field they were given through unchanged, and any not listed here
+# only return that one field.
+DERIVED_FIELDS = {
+    extra_request_from_first_line: REQUEST_FIRST_LINE_FIELDS,
+    parse_user_agent: USER_AGENT_FIELDNAMES,
+    format_time: TIME_FIELDS,
+}
+
+# Precompiled versions of FORMAT_STRINGS
+FORMAT_STRINGS_REGEX = re.compile("("+"|".join(x[0] for x in FORMAT_STRINGS)+")")
+
+DIRECTIVES = [(re.compile("^"+pattern_regex+"$"), log_part_regex, name_func, values_func)
+              for pattern_regex, log_part_regex, name_func, values_func in FORMAT_STRINGS]
+
+_format_fields_cache = {}
+
+def format_fields(format_string):
+    """
+    Split format_string into its fields, without compiling any regexes.
+    Returns a list of (literal text before it, directive, name, regex,
+    post processor) for each field, and the literal text at the end.
+    """
+    try:
+        return _format_fields_cache[format_string]
+    except KeyError:
+        pass
+
+    parts = FORMAT_STRINGS_REGEX.split(format_string)
+    fields = []
+    for i in range(1, len(parts), 2):
+        raw, directive, following = parts[i-1], parts[i], parts[i+1]
+        for directive_regex, log_part_regex, name_func, values_func in DIRECTIVES:
+            match = directive_regex.match(directive)
+            if match:
+                name = name_func(match.group())
+                log_part_regex = tighten_field_regex(log_part_regex, directive, following, at_end=i + 2 == len(parts))
+                fields.append((raw, directive, name, log_part_regex, values_func))
+                break
+        else:
+            # Not a directive we know, so leave the text out
+            parts[i+1] = raw + parts[i+1]
+    result = (fields, parts[-1])
+
+    if len(_format_fields_cache) >= PARSER_CACHE_SIZE:
+        _format_fields_cache.clear()
+    _format_fields_cache[format_string] = result
+    return result
+
+def _project(format_string, fields, wanted):
+    """
+    For the fields from format_fields, return the keys each one adds to the
+    results when only ``wanted`` (None for all) are asked for. Raises
+    ValueError if some of ``wanted`` aren't in the format.
+    """
+    projected = []
+    for raw, directive, name, log_part_regex, values_func in fields:
+        derived_names = DERIVED_FIELDS.get(values_func, (name,))
+        if wanted is not None:
+            derived_names = tuple(x for x in derived_names if x in wanted)
+        projected.append(derived_names)
+    if wanted is not None:
+        unknown = set(wanted).difference(*projected)
+        if unknown:
+            raise ValueError("Format string {0!r} has no field(s) {1}".format(format_string, ", ".join(sorted(unknown))))
+    return projected
+
+READ_BUFFER_SIZE = 1024 * 1024
+
+def _open_binary(path):
+    """
+    Open path for reading bytes through a large buffer, decompressing it if
+    it's gzip, bz2 or xz. Returns (file object, whether it's compressed)
+    """
+    with io.open(path, 'rb') as f:
+        magic = f.read(6)
+    if magic.startswith(b'\x1f\x8b'):
+        raw = gzip.open(path, 'rb')
+    elif magic.startswith(b'BZh'):
+        raw = bz2.BZ2File(path, 'rb')
+    elif magic.startswith(b'\xfd7zXZ\x00') and lzma is not None:
+        raw = lzma.open(path, 'rb')
+    else:
+        return io.open(path, 'rb', buffering=READ_BUFFER_SIZE), False
+    return io.BufferedReader(raw, READ_BUFFER_SIZE), True
+
+DEFAULT_ENCODING = 'utf-8'
+
+DEFAULT_ERRORS = 'replace'
+
+def open_log_file(path, encoding=DEFAULT_ENCODING, errors=DEFAULT_ERRORS):
+    """
+    Open a log file for reading lines. Rotated logs compressed with gzip,
+    bz2 or xz are decompressed as they are read
+    """
+    f, compressed = _open_binary(path)
+    return io.TextIOWrapper(f, encoding=encoding, errors=errors)
+
+ON_ERROR_POLICIES = ('raise', 'skip', 'yield_error')
+
+def _check_on_error(on_error):
+    if not (on_error in ON_ERROR_POLICIES or callable(on_error)):
+        raise ValueError("on_error should be one of {0}, or a function, not {1!r}".format(", ".join(ON_ERROR_POLICIES), on_error))
+
+ENGINES = ('generated', 'generic')
+
+DEFAULT_ENGINE = 'generated'
+
+class LazyLogLine(Mapping):
+    """
+    Read only mapping of the values from one log line, where the derived
+    fields (request_header_user_agent__*, time_received_*, etc.) are only
+    calculated the first time one of them is looked up.
+    """
+    __slots__ = ('_values', '_raw', '_derived', '_keys')
+
+    def __init__(self, values, raw, derived, keys):
+        # values: the values known so far
+        # raw: the matched string for each field with a post processor
+        # derived: for each derived key, the field name & post processor that makes it
+        # keys: all the keys, in order
+        self._values = values
+        self._raw = raw
+        self._derived = derived
+        self._keys = keys
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        name, values_func = self._derived[key]
+        if key == name:
+            return self._raw[name]
+        derived = self._derived
+        for derived_key, value in values_func({name: self._raw[name]}).items():
+            if derived_key in derived:
+                self._values[derived_key] = value
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values or key in self._derived
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return "LazyLogLine({0!r})".format(dict(self))
+
+RECORD_TYPES = ('dict', 'slots')
+
+# Fields with only a few different values, which are shared between records
+INTERNED_FIELDS = ('request_method', 'request_http_ver', 'status', 'server_name', 'protocol')
+
+# How many different values of each field are shared, after that new values
+# aren't kept
+INTERN_TABLE_SIZE = 1024
+
+def _interner(maxsize=INTERN_TABLE_SIZE):
+    """Return a function that returns the first equal value it was given, for up to maxsize values"""
+    table = {}
+    def intern_value(value):
+        try:
+            return table[value]
+        except KeyError:
+            if len(table) < maxsize:
+                table[value] = value
+            return value
+    return intern_value
+
+class LogRecord(Mapping):
+    """
+    Base class for the records made with ``record="slots"``: one subclass per
+    set of keys (see record_class), which keeps the values in ``__slots__``
+    rather than a dict. It's a read only mapping like the dict results, and
+    the values are also attributes, e.g. ``record.status``.
+    """
+    __slots__ = ()
+
+    # The keys, in order, and the attribute for each one
+    _fields = ()
+    _attrs = {}
+
+    def __getitem__(self, key):
+        try:
+            attr = self._attrs[key]
+        except KeyError:
+            raise KeyError(key)
+        return getattr(self, attr)
+
+    def __contains__(self, key):
+        return key in self._attrs
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return "LogRecord({0!r})".format(dict(self))
+
+    def __reduce__(self):
+        # The class is made at run time, so it's pickled as the keys & values
+        return (_unpickle_record, (self._fields, tuple(getattr(self, self._attrs[key]) for key in self._fields)))
+
+_record_classes = {}
+_record_classes_lock = threading.Lock()
+
+def record_class(keys):
+    """
+    Return the LogRecord subclass for these keys (made the first time it's
+    asked for), which is called with the values in the same order
+    """
+    keys = tuple(keys)
+    cls = _record_classes.get(keys)
+    if cls is not None:
+        return cls
+    attrs = OrderedDict()
+    for key in keys:
+        # Keys like "request_header_x.y" aren't identifiers
+        attr = re.sub(r'\W', '_', key)
+        if not re.match(r'[A-Za-z]', attr):
+            attr = 'f_' + attr
+        while attr in attrs.values() or attr in ('keys', 'items', 'values', 'get'):
+            attr += '_'
+        attrs[key] = attr
+    args = ", ".join("v{0}".format(i) for i in range(len(keys)))
+    lines = ["def __init__(self{0}{1}):".format(", " if keys else "", args)]
+    lines.extend("    self.{0} = v{1}".format(attr, i) for i, attr in enumerate(attrs.values()))
+    lines.append("    pass")
+    namespace = {}
+    exec(compile("\n".join(lines) + "\n", "<apache_log_parser record>", "exec"), namespace)
+    cls = type('LogRecord', (LogRecord,), {
+        '__slots__': tuple(attrs.values()), '_fields': keys, '_attrs': dict(attrs), '__init__': namespace['__init__'],
+        '__module__': __name__})
+    with _record_classes_lock:
+        return _record_classes.setdefault(keys, cls)
+
+def _unpickle_record(keys, values):
+    return record_class(keys)(*values)
+
+# array typecodes for the fields that parse_batch can return as numbers.
+# time_received is seconds since the epoch.
+TYPED_COLUMNS = {
+    'status': 'h',
+    'response_bytes': 'q',
+    'response_bytes_clf': 'q',
+    'time_us': 'q',
+    'bytes_rx': 'q',
+    'bytes_tx': 'q',
+    'time_received': 'q',
+}
+
+NUMPY_DTYPES = {'h': 'int16', 'q': 'int64'}
+
+# Value in a typed column when the field isn't a number, e.g. "-" for %b
+MISSING_INT = -1
+
+DEFAULT_BATCH_SIZE = 10000
+
+def _int_column(values, typecode):
+    try:
+        return array(typecode, map(int, values))
+    except (ValueError, OverflowError):
+        # Some "-"s or other non numbers, or numbers too big for typecode
+        column = array(typecode)
+        append = column.append
+        for value in values:
+            try:
+                append(int(value))
+            except (ValueError, OverflowError):
+                append(MISSING_INT)
+        return column
+
+def _epoch(time_received):
+    """Seconds since the epoch for a %t string, e.g. "[10/Oct/2000:13:55:36 -0700]" """
+    s = time_received[1:-1]
+    offset = int(s[22:24], 10) * 3600 + int(s[24:26], 10) * 60
+    if s[21] == '-':
+        offset = -offset
+    elif s[21] != '+':
+        raise ValueError("Bad timezone offset in {0!r}".format(time_received))
+    return calendar.timegm((int(s[7:11]), MONTH_MAP[s[3:6]], int(s[0:2]),
+                            int(s[12:14]), int(s[15:17]), int(s[18:20]))) - offset
+
+def _epoch_column(values):
+    column = array('q')
+    last_value = last_epoch = None
+    for value in values:
+        if value != last_value:
+            try:
+                last_epoch = _epoch(value)
+            except (ValueError, KeyError):
+                last_epoch = MISSING_INT
+            last_value = value
+        column.append(last_epoch)
+    return column
+
+class FieldFilter(object):
+    """
+    A test of the string captured for a field, for Parser's ``filters``.
+    Subclasses define ``test(value)``, and can define ``substrings(before,
+    after)``, which is given the format's literal text just before & after
+    the field, and returns strings, at least one of which is in every line
+    where the field passes the test (or None if there aren't any). Lines
+    with none of them are rejected without running the line regex.
+    """
+
+    def test(self, value):
+        raise NotImplementedError
+
+    def substrings(self, before, after):
+        return None
+
+    def _key(self):
+        return ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), self._key()))
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, ", ".join(repr(x) for x in self._key()))
+
+class Equals(FieldFilter):
+    """The field is one of ``values``"""
+
+    def __init__(self, *values):
+        self.values = frozenset(values)
+
+    def test(self, value):
+        return value in self.values
+
+    def substrings(self, before, after):
+        return tuple(before + value + after for value in sorted(self.values))
+
+    def _key(self):
+        return tuple(sorted(self.values))
+
+class Prefix(FieldFilter):
+    """The field starts with one of ``prefixes``"""
+
+    def __init__(self, *prefixes):
+        self.prefixes = tuple(sorted(set(prefixes)))
+
+    def test(self, value):
+        return value.startswith(self.prefixes)
+
+    def substrings(self, before, after):
+        return tuple(before + prefix for prefix in self.prefixes)
+
+    def _key(self):
+        return self.prefixes
+
+class Range(FieldFilter):
+    """
+    The field is a whole number from ``low`` to ``high`` (inclusive), e.g.
+    ``Range(500, 599)`` for 5xx statuses. Either can be None. Values that
+    aren't numbers (e.g. ``-``) don't pass.
+    """
+
+    def __init__(self, low=None, high=None):
+        self.low = low
+        self.high = high
+
+    def test(self, value):
+        try:
+            number = int(value)
+        except ValueError:
+            return False
+        return (self.low is None or number >= self.low) and (self.high is None or number <= self.high)
+
+    def substrings(self, before, after):
+        # Numbers as Apache writes them (no sign or leading zeros) with the
+        # same number of digits as low & high start with their common
+        # prefix, e.g. "5" for 500 to 599
+        if self.low is None or self.high is None or self.low < 0:
+            return None
+        low, high = str(self.low), str(self.high)
+        prefix = os.path.commonprefix([low, high])
+        if len(low) != len(high) or not prefix:
+            return None
+        return (before + prefix,)
+
+    def _key(self):
+        return (self.low, self.high)
+
+def _to_epoch(value):
+    if isinstance(value, datetime):
+        # Naive datetimes are taken to be UTC
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+class TimeRange(FieldFilter):
+    """
+    The %t field is from ``start`` (inclusive) up to ``end`` (exclusive),
+    which are datetimes (UTC if they're naive) or seconds since the epoch.
+    Either can be None. Lines are in time order, so the result for the
+    last value is remembered.
+    """
+
+    def __init__(self, start=None, end=None):
+        self.start = _to_epoch(start)
+        self.end = _to_epoch(end)
+        self._last = (None, False)
+
+    def test(self, value):
+        last_value, passed = self._last
+        if value == last_value:
+            return passed
+        try:
+            epoch = _epoch(value)
+        except (ValueError, KeyError):
+            passed = False
+        else:
+            passed = (self.start is None or epoch >= self.start) and (self.end is None or epoch < self.end)
+        self._last = (value, passed)
+        return passed
+
+    def _key(self):
+        return (self.start, self.end)
+
+def make_filter(value):
+    """
+    Return the FieldFilter for a value in Parser's ``filters``: a FieldFilter
+    as is, a string for Equals, or a list/tuple/set of strings for Equals
+    any of them
+    """
+    if isinstance(value, FieldFilter):
+        return value
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return Equals(*value)
+    else:
+        return Equals(value)
+
+def _decoded_test(test, encoding, errors):
+    def decoded_test(value):
+        return test(value.decode(encoding, errors))
+    return decoded_test
+
+# What a filtered line regex match gives for lines that matched, but didn't
+# pass the filters
+_FILTERED = object()
+
+# ...and for lines without the text the filters need, which weren't matched
+# at all, so they may not have matched the format either
+_SKIPPED = object()
+
+def _filter_match(match_line, substrings, checks):
+    """
+    Wrap a line regex's match method, so that lines that don't have one of
+    each of ``substrings`` aren't matched at all and give _SKIPPED, and
+    matches where one of ``checks`` (group number, test) fails give _FILTERED
+    """
+    def match_filtered(line, pos=0, end=None):
+        if end is None:
+            end = len(line)
+        find = line.find
+        for alternatives in substrings:
+            for substring in alternatives:
+                if find(substring, pos, end) != -1:
+                    break
+            else:
+                return _SKIPPED
+        match = match_line(line, pos, end)
+        if match is not None:
+            group = match.group
+            for index, test in checks:
+                if not test(group(index)):
+                    return _FILTERED
+        return match
+    return match_filtered
+
+class _DecodedMatch(object):
+    """Wraps a match on a bytes line, so that groupdict() returns decoded strings"""
+
+    def __init__(self, match, parser):
+        self.match = match
+        self.parser = parser
+
+    def groupdict(self):
+        encoding, errors, field_encodings = self.parser.encoding, self.parser.errors, self.parser.field_encodings
+        return dict((name, value.decode(field_encodings.get(name, encoding), errors))
+                    for name, value in self.match.groupdict().items())
+
+# Wall clock for profiling, the most precise one there is
+timer = getattr(time, 'perf_counter', time.time)
+
+class ParserStats(object):
+    """
+    Cumulative call counts & wall time for each stage of parsing a line, for
+    a Parser made with ``profile=True``. The stages are ``line_regex``
+    (matching the line, and ``match_failures`` counts the lines that didn't
+    match), ``build`` (making the result from a match, including the post
+    processors) and one for each field with a post processor, named after the
+    field (e.g. ``request_header_user_agent``).
+
+    If there's a ``hook``, ``export`` calls it with a snapshot, and it's
+    called automatically every ``interval`` lines when that is set (just
+    before the next line is matched).
+    """
+
+    def __init__(self, name=None, hook=None, interval=None):
+        if interval is not None and interval < 1:
+            raise ValueError("interval must be at least 1, not {0!r}".format(interval))
+        self.name = name
+        self.hook = hook
+        self.interval = interval
+        self.match_failures = 0
+        # stage name -> [calls, seconds], changed in place by the wrappers
+        self._stages = OrderedDict((stage, [0, 0.0]) for stage in ('line_regex', 'build'))
+
+    def _counter(self, stage):
+        counter = self._stages.get(stage)
+        if counter is None:
+            counter = self._stages[stage] = [0, 0.0]
+        return counter
+
+    def timed(self, stage, func):
+        """Return a wrapper around func that counts its calls & time as stage"""
+        counter = self._counter(stage)
+        def timed_func(*args):
+            start = timer()
+            try:
+                return func(*args)
+            finally:
+                counter[1] += timer() - start
+                counter[0] += 1
+        return timed_func
+
+    def timed_match(self, match):
+        """Like timed, for the line regex's match method, which also counts failures"""
+        counter = self._counter('line_regex')
+        def timed_match(*args):
+            # Export between lines, so that each snapshot has whole lines
+            if self.interval is not None and counter[0] >= self.interval:
+                self.export()
+            start = timer()
+            result = match(*args)
+            counter[1] += timer() - start
+            counter[0] += 1
+            if result is None:
+                self.match_failures += 1
+            return result
+        return timed_match
+
+    def snapshot(self):
+        """Return the counts so far as plain dicts"""
+        return {
+            'name': self.name,
+            'match_failures': self.match_failures,
+            'stages': OrderedDict((stage, {'calls': calls, 'seconds': seconds})
+                                  for stage, (calls, seconds) in self._stages.items()),
+        }
+
+    def reset(self):
+        self.match_failures = 0
+        for counter in self._stages.values():
+            counter[:] = [0, 0.0]
+
+    def export(self, reset=True):
+        """Pass a snapshot to the hook (if there is one), then reset the counts"""
+        snapshot = self.snapshot()
+        if self.hook is not None:
+            self.hook(snapshot)
+        if reset:
+            self.reset()
+        return snapshot
+
 class Parser:
-    def __init__(self, format_string):
+    """
+    Parser for one apache LogFormat string.
+
+    ``fields`` is an optional list of the keys to return, which can be field
+    names (e.g. ``status``) or derived names (e.g. ``request_url``). Fields
+    that aren't needed for any of them aren't captured, and their post
+    processors (User-Agent parsing, time decoding, ...) are never run.
+    ``fieldnames`` has the keys that each line will have.
+
+    With ``lazy=True``, ``parse`` returns a LazyLogLine, which only runs the
+    post processors when one of their derived keys is first looked up.
+
+    With ``record="slots"`` the results are LogRecords instead of dicts,
+    which take much less memory, and the values of INTERNED_FIELDS are
+    shared between them.
+
+    ``parse_stream`` and ``parse_file`` parse many lines, counting them in
+    ``lines_matched`` and ``lines_unmatched``.
+
+    ``parse_batch`` and ``parse_batches`` return the fields from many lines
+    as columns, optionally with numbers (see TYPED_COLUMNS) in arrays.
+
+    Lines can also be parsed as bytes, with ``parse_bytes`` or
+    ``parse_mmap``, using a bytes version of the regex
+    (``log_line_regex_bytes``). Each field is decoded with ``encoding`` (or
+    the encoding in ``field_encodings`` for that field name) and ``errors``,
+    which are also used to read files in ``parse_file``.
+
+    ``engine`` is how lines are turned into results: "generated" (the
+    default, see DEFAULT_ENGINE) compiles a parse function just for this
+    format string, "generic" loops over ``functions_to_parse`` for each line.
+
+    User-Agent parsing results are memoized in a UserAgentCache of
+    ``user_agent_cache_size`` entries (available as ``self.user_agent_cache``),
+    pass ``None`` or 0 to parse every User-Agent from scratch. The same goes
+    for ``time_cache_size`` and the decoded %t fields in ``self.time_cache``.
+
+    With ``profile=True`` the time spent in each stage is recorded in a
+    ParserStats (``self.profile_stats``), see ``stats``, ``reset_stats`` and
+    ``export_stats``. ``stats_hook`` and ``stats_interval`` are passed on to
+    it. Without it, nothing is timed and there's no extra work per line.
+
+    ``filters`` is a dict of field names (e.g. ``status``, not derived names)
+    and FieldFilters (Equals, Prefix, Range, TimeRange, or a string or list
+    of strings for Equals, see make_filter). Lines where a field doesn't
+    pass its filter are skipped before any post processing, and counted in
+    ``lines_filtered``, and ``parse`` returns None for them. Where they can,
+    the filters also give strings that must be in the line, which are
+    looked for before the regex is run. Lines without them are skipped too,
+    and counted in ``lines_skipped``, without finding out if they match the
+    format, so ``on_error`` isn't called for those that don't.
+    """
+    def __init__(self, format_string, fields=None, lazy=False, engine=None,
+                 user_agent_cache_size=DEFAULT_USER_AGENT_CACHE_SIZE,
+                 time_cache_size=DEFAULT_TIME_CACHE_SIZE,
+                 encoding=DEFAULT_ENCODING, errors=DEFAULT_ERRORS, field_encodings=None,
+                 profile=False, stats_hook=None, stats_interval=None, filters=None, record='dict'):
+        # To rebuild this parser when it's unpickled
+        self._kwargs = dict(
+            fields=fields, lazy=lazy, engine=engine, user_agent_cache_size=user_agent_cache_size,
+            time_cache_size=time_cache_size, encoding=encoding, errors=errors, field_encodings=field_encodings,
+            profile=profile, stats_hook=stats_hook, stats_interval=stats_interval, filters=filters, record=record)
         self.names = []
+        self.lines_matched = 0
+        self.lines_unmatched = 0
+        self.lines_filtered = 0
+        self.lines_skipped = 0
+        self.fields = None if fields is None else tuple(fields)
+        self.lazy = lazy
+        self.encoding = encoding
+        self.errors = errors
+        self.field_encodings = dict(field_encodings or {})
+        self.engine = DEFAULT_ENGINE if engine is None else engine
+        if self.engine not in ENGINES:
+            raise ValueError("Unknown engine {0!r}, should be one of {1}".format(self.engine, ", ".join(ENGINES)))
+        self.record = record
+        if record not in RECORD_TYPES:
+            raise ValueError("Unknown record type {0!r}, should be one of {1}".format(record, ", ".join(RECORD_TYPES)))
+        if lazy and record != 'dict':
+            raise ValueError("Lazy results are always LazyLogLines, so record can't be {0!r}".format(record))
 
-        self.pattern = "("+"|".join(x[0] for x in FORMAT_STRINGS)+")"
-        self.parts = re.split(self.pattern, format_string)
+        if user_agent_cache_size:
+            self.user_agent_cache = UserAgentCache(user_agent_cache_size)
+        else:
+            self.user_agent_cache = None
+        if time_cache_size:
+            self.time_cache = TimeCache(time_cache_size)
+        else:
+            self.time_cache = None
+
+        if profile:
+            self.profile_stats = ParserStats(format_string, hook=stats_hook, interval=stats_interval)
+        else:
+            self.profile_stats = None
+
+        self.format_string = format_string
+        self.pattern = FORMAT_STRINGS_REGEX.pattern
 
         self.functions_to_parse = {}
+        # All the keys that each field can add to the results
+        self.derived_names = {}
+        fieldnames = []
+        lazy_names = []
+
+        format_fields_list, trailing = format_fields(format_string)
+        projected = _project(format_string, format_fields_list, self.fields)
+
+        self.filters = dict((name, make_filter(value)) for name, value in (filters or {}).items())
+        unknown = set(self.filters).difference(field[2] for field in format_fields_list)
+        if unknown:
+            raise ValueError("Format string {0!r} has no field(s) {1} to filter on".format(format_string, ", ".join(sorted(unknown))))
+        # For each filter, strings of which one must be in the line
+        filter_substrings = []
 
         self.log_line_regex = ""
-        while True:
-            if len(self.parts) == 0:
-                break
-            if len(self.parts) == 1:
-                raw, regex = self.parts.pop(0), None
-            elif len(self.parts) >= 2:
-                raw, regex = self.parts.pop(0), self.parts.pop(0)
+        for index, ((raw, directive, name, log_part_regex, values_func), derived_names) in enumerate(zip(format_fields_list, projected)):
             if len(raw) > 0:
                 self.log_line_regex += re.escape(raw)
-            if regex is not None:
-                for format_spec in FORMAT_STRINGS:
-                    pattern_regex, log_part_regex, name_func, values_func = format_spec
-                    match = re.match("^"+pattern_regex+"$", regex)
-                    if match:
-                        name = name_func(match.group())
-                        self.names.append(name)
-                        self.functions_to_parse[name] = values_func
-                        self.log_line_regex += "(?P<"+name+">"+log_part_regex+")"
-                        break
+            self.names.append(name)
+            self.derived_names[name] = DERIVED_FIELDS.get(values_func, (name,))
+            if name in self.filters:
+                following = format_fields_list[index+1][0] if index+1 < len(format_fields_list) else trailing
+                substrings = self.filters[name].substrings(raw, following)
+                if substrings:
+                    filter_substrings.append((name, tuple(substrings)))
+            if len(derived_names) == 0:
+                if name in self.filters:
+                    # Only captured for its filter
+                    self.log_line_regex += "(?P<"+name+">"+log_part_regex+")"
+                else:
+                    # Not wanted, so don't capture it
+                    self.log_line_regex += "(?:"+log_part_regex+")"
+                continue
+            fieldnames.extend(derived_names)
+            if values_func in DERIVED_FIELDS:
+                lazy_names.append(name)
+            if values_func is parse_user_agent:
+                values_func = partial(parse_user_agent, cache=self.user_agent_cache)
+            elif values_func is format_time:
+                values_func = partial(format_time, cache=self.time_cache)
+            if profile and values_func is not identity:
+                values_func = self.profile_stats.timed(name, values_func)
+            self.functions_to_parse[name] = values_func
+            self.log_line_regex += "(?P<"+name+">"+log_part_regex+")"
+        if len(trailing) > 0:
+            self.log_line_regex += re.escape(trailing)
 
         self._log_line_regex_raw = self.log_line_regex
         self.log_line_regex = re.compile(self.log_line_regex)
+        self._match_line = self.log_line_regex.match
         self.names = tuple(self.names)
+        self.fieldnames = tuple(fieldnames)
+
+        # Keys that the post processors make, but which weren't asked for
+        self._unwanted = tuple(
+            key for name in self.functions_to_parse for key in self.derived_names[name]
+            if key not in self.fieldnames)
+
+        # For lazy results: the fields with post processors, and which field makes each derived key
+        self._lazy_names = tuple(lazy_names)
+        self._plain_names = tuple(name for name in self.functions_to_parse if name not in lazy_names)
+        self._lazy_derived = dict(
+            (key, (name, self.functions_to_parse[name]))
+            for name in self._lazy_names for key in self.derived_names[name]
+            if key in self.fieldnames)
+
+        if record == 'slots':
+            self.record_class = record_class(self.fieldnames)
+            self._interners = dict((key, _interner()) for key in INTERNED_FIELDS if key in self.fieldnames)
+        else:
+            self.record_class = None
+
+        if self.engine == 'generated':
+            self._build = self._generate_build()
+        else:
+            self._build = self._build_generic
+        if profile:
+            self._match_line = self.profile_stats.timed_match(self._match_line)
+            self._build = self.profile_stats.timed('build', self._build)
+
+        self._filter_substrings = tuple(filter_substrings)
+        self._filter_checks = tuple(
+            (self.log_line_regex.groupindex[name], self.filters[name].test) for name in sorted(self.filters))
+        if self.filters:
+            self._match_line = _filter_match(
+                self._match_line, tuple(substrings for name, substrings in self._filter_substrings), self._filter_checks)
+
+        # The bytes versions are only made when they're first needed
+        self._log_line_regex_bytes = None
+        self._match_line_bytes = None
+        self._build_bytes = None
+
+    @property
+    def log_line_regex_bytes(self):
+        if self._log_line_regex_bytes is None:
+            self._log_line_regex_bytes = re.compile(self._log_line_regex_raw.encode('utf-8'))
+            if self.engine == 'generated':
+                self._build_bytes = self._generate_build(decode=True)
+            else:
+                self._build_bytes = lambda match: self._build_generic(_DecodedMatch(match, self))
+            self._match_line_bytes = self._log_line_regex_bytes.match
+            if self.profile_stats is not None:
+                self._match_line_bytes = self.profile_stats.timed_match(self._match_line_bytes)
+                self._build_bytes = self.profile_stats.timed('build', self._build_bytes)
+            if self.filters:
+                self._match_line_bytes = _filter_match(
+                    self._match_line_bytes, self._filter_substrings_bytes(), self._filter_checks_bytes())
+        return self._log_line_regex_bytes
+
+    def _filter_substrings_bytes(self):
+        substrings_bytes = []
+        for name, substrings in self._filter_substrings:
+            # The bytes regex is in UTF-8, so these can only be used if the
+            # field is too
+            if codecs.lookup(self.field_encodings.get(name, self.encoding)).name != 'utf-8':
+                continue
+            substrings_bytes.append(tuple(substring.encode('utf-8') for substring in substrings))
+        return tuple(substrings_bytes)
+
+    def _filter_checks_bytes(self):
+        # The filters are tests of strings, so decode the fields first
+        return tuple(
+            (index, _decoded_test(test, self.field_encodings.get(name, self.encoding), self.errors))
+            for (index, test), name in zip(self._filter_checks, sorted(self.filters)))
+
+    def __reduce__(self):
+        # Pickled as the format string & options, and rebuilt (or found in
+        # the parser cache) when unpickled
+        return (_unpickle_parser, (self.format_string, self._kwargs))
+
+    def stats(self, reset=False):
+        """
+        Return a snapshot of the profiling counts (see ParserStats), and
+        reset them with ``reset=True``. Only for parsers made with
+        ``profile=True``.
+        """
+        if self.profile_stats is None:
+            raise ValueError("This parser isn't profiled, make it with profile=True")
+        snapshot = self.profile_stats.snapshot()
+        if reset:
+            self.profile_stats.reset()
+        return snapshot
+
+    def reset_stats(self):
+        self.stats(reset=True)
+
+    def export_stats(self, reset=True):
+        """Pass a snapshot of the profiling counts to ``stats_hook``, and return it"""
+        if self.profile_stats is None:
+            raise ValueError("This parser isn't profiled, make it with profile=True")
+        return self.profile_stats.export(reset=reset)
 
     def parse(self, log_line):
-        match = self.log_line_regex.match(log_line)
+        match = self._match_line(log_line)
         if match is None:
             raise LineDoesntMatchException(log_line=log_line, regex=self.log_line_regex.pattern)
+        elif match is _FILTERED or match is _SKIPPED:
+            return None
+        else:
+            return self._build(match)
+
+    def parse_stream(self, lines, on_error='raise'):
+        """
+        Parse an iterable of lines (e.g. an open file), yielding the results
+        for each line. Trailing newlines are removed first.
+
+        ``on_error`` says what to do with lines that don't match: "raise" a
+        LineDoesntMatchException, "skip" them, "yield_error" (yield a
+        LineDoesntMatchException instead of the results), or a function
+        which is called with the line. Only "raise" and "yield_error" create
+        an exception object. With ``filters``, lines skipped because they
+        don't have the text a filter needs never get as far as the regex, so
+        they aren't given to ``on_error`` even if they don't match (see
+        ``lines_skipped``).
+
+        If the lines are bytes (e.g. from a file opened in binary mode) they
+        are matched as bytes and the fields decoded, as for parse_bytes, and
+        the bad lines given to ``on_error`` are bytes too.
+        """
+        _check_on_error(on_error)
+        return self._parse_stream(lines, on_error)
+
+    def _parse_stream(self, lines, on_error, build=None):
+        lines = iter(lines)
+        for first in lines:
+            break
+        else:
+            return
+        if isinstance(first, (str, type(u''))):
+            regex = self.log_line_regex
+            match_line = self._match_line
+            build = build or self._build
+            newline = "\r\n"
+        else:
+            # Compiles the bytes regex (and _match_line_bytes) if need be
+            regex = self.log_line_regex_bytes
+            match_line = self._match_line_bytes
+            build = build or self._build_bytes
+            newline = b"\r\n"
+        for line in chain((first,), lines):
+            line = line.rstrip(newline)
+            match = match_line(line)
+            if match is not None:
+                if match is _FILTERED:
+                    self.lines_filtered += 1
+                    continue
+                elif match is _SKIPPED:
+                    self.lines_skipped += 1
+                    continue
+                self.lines_matched += 1
+                yield build(match)
+            else:
+                self.lines_unmatched += 1
+                if on_error == 'skip':
+                    continue
+                elif on_error == 'raise':
+                    raise LineDoesntMatchException(log_line=line, regex=regex.pattern)
+                elif on_error == 'yield_error':
+                    yield LineDoesntMatchException(log_line=line, regex=regex.pattern)
+                else:
+                    on_error(line)
+
+    def parse_file(self, path, on_error='raise'):
+        """
+        Parse the log file at path (which may be compressed, see
+        open_log_file), yielding the results for each line. ``on_error`` is
+        as for parse_stream.
+        """
+        _check_on_error(on_error)
+        return self._parse_file(path, on_error)
+
+    def _parse_file(self, path, on_error):
+        with open_log_file(path, encoding=self.encoding, errors=self.errors) as f:
+            for result in self._parse_stream(f, on_error):
+                yield result
+
+    def parse_batch(self, lines, typed=True, use_numpy=None, on_error='raise'):
+        """
+        Parse an iterable of lines, and return a dict of columns: for each
+        captured field (see ``functions_to_parse``), a list of the strings
+        from each line. Post processors aren't run, so there are no derived
+        fields.
+
+        With ``typed=True`` the fields in TYPED_COLUMNS are ``array.array``s
+        of integers instead, with MISSING_INT where the value isn't a number.
+        ``time_received`` is the seconds since the epoch. If NumPy is
+        installed (or with ``use_numpy=True``), they're NumPy arrays.
+
+        ``on_error`` is "raise", "skip", or a function called with bad lines.
+        """
+        if on_error == 'yield_error':
+            raise ValueError("on_error can't be 'yield_error' for parse_batch")
+        _check_on_error(on_error)
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise ImportError("NumPy isn't installed")
+
+        names = tuple(self.functions_to_parse)
+        columns = dict((name, []) for name in names)
+        appenders = [(self.log_line_regex.groupindex[name] - 1, columns[name].append) for name in names]
+        match_line = self._match_line
+        for line in lines:
+            line = line.rstrip("\r\n")
+            match = match_line(line)
+            if match is None:
+                self.lines_unmatched += 1
+                if on_error == 'raise':
+                    raise LineDoesntMatchException(log_line=line, regex=self.log_line_regex.pattern)
+                elif on_error != 'skip':
+                    on_error(line)
+                continue
+            elif match is _FILTERED:
+                self.lines_filtered += 1
+                continue
+            elif match is _SKIPPED:
+                self.lines_skipped += 1
+                continue
+            self.lines_matched += 1
+            g = match.groups()
+            for index, append in appenders:
+                append(g[index])
+
+        if typed:
+            for name in names:
+                typecode = TYPED_COLUMNS.get(name)
+                if typecode is None:
+                    continue
+                if name == 'time_received':
+                    column = _epoch_column(columns[name])
+                else:
+                    column = _int_column(columns[name], typecode)
+                if use_numpy:
+                    column = numpy.frombuffer(column, dtype=NUMPY_DTYPES[typecode])
+                columns[name] = column
+
+        return columns
+
+    def parse_batches(self, lines, batch_size=DEFAULT_BATCH_SIZE, **kwargs):
+        """
+        Like parse_batch, but yields the columns for every ``batch_size``
+        lines, so that only one batch is in memory at a time
+        """
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= batch_size:
+                yield self.parse_batch(batch, **kwargs)
+                batch = []
+        if batch:
+            yield self.parse_batch(batch, **kwargs)
+
+    def parse_bytes(self, log_line):
+        """Parse one line of bytes, with the fields decoded to strings"""
+        regex = self.log_line_regex_bytes
+        match = self._match_line_bytes(log_line)
+        if match is None:
+            raise LineDoesntMatchException(log_line=log_line, regex=regex.pattern)
+        elif match is _FILTERED or match is _SKIPPED:
+            return None
+        else:
+            return self._build_bytes(match)
+
+    def parse_mmap(self, path_or_buffer, on_error='raise'):
+        """
+        Parse all the lines in an uncompressed log file, yielding the results
+        for each line. The file is mmap-ed and the bytes regex is matched
+        against each line in place, so the file is never split into line
+        strings, and only the matched fields are copied & decoded.
+        ``path_or_buffer`` can be a str or ``pathlib.Path``, or a bytes
+        object or an existing mmap (anything with a ``find`` method).
+
+        ``on_error`` is as for parse_stream, with the bad line as bytes.
+        """
+        _check_on_error(on_error)
+        return self._parse_mmap(path_or_buffer, on_error)
+
+    def _parse_mmap(self, path_or_buffer, on_error):
+        # Buffers are searched with find(). A str has that too, but is a path.
+        if hasattr(path_or_buffer, 'find') and not isinstance(path_or_buffer, (str, type(u''))):
+            for result in self._parse_buffer(path_or_buffer, on_error):
+                yield result
+            return
+        with io.open(path_or_buffer, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files can't be mmap-ed
+                return
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for result in self._parse_buffer(buf, on_error):
+                    yield result
+            finally:
+                buf.close()
+
+    def _parse_buffer(self, buf, on_error, build=None):
+        # Compiles the bytes regex (and _match_line_bytes) if need be
+        regex = self.log_line_regex_bytes
+        match_line = self._match_line_bytes
+        build = build or self._build_bytes
+        find = buf.find
+        size = len(buf)
+        pos = 0
+        while pos < size:
+            end = find(b"\n", pos)
+            if end == -1:
+                end = next_pos = size
+            else:
+                next_pos = end + 1
+            if end > pos and buf[end-1:end] == b"\r":
+                end -= 1
+            match = match_line(buf, pos, end)
+            if match is _FILTERED:
+                self.lines_filtered += 1
+            elif match is _SKIPPED:
+                self.lines_skipped += 1
+            elif match is not None:
+                self.lines_matched += 1
+                yield build(match)
+            else:
+                self.lines_unmatched += 1
+                if on_error == 'skip':
+                    pass
+                elif on_error == 'raise':
+                    raise LineDoesntMatchException(log_line=buf[pos:end], regex=regex.pattern)
+                elif on_error == 'yield_error':
+                    yield LineDoesntMatchException(log_line=buf[pos:end], regex=regex.pattern)
+                else:
+                    on_error(buf[pos:end])
+            pos = next_pos
+
+    def _build_generic(self, match):
+        if self.lazy:
+            groupdict = match.groupdict()
+            values = dict((name, groupdict[name]) for name in self._plain_names)
+            raw = dict((name, groupdict[name]) for name in self._lazy_names)
+            return LazyLogLine(values, raw, self._lazy_derived, self.fieldnames)
         else:
             results = {}
             for name in self.functions_to_parse:
                 values = {name: match.groupdict()[name]}
                 values = self.functions_to_parse[name](values)
                 results.update(values)
+            for key in self._unwanted:
+                results.pop(key, None)
+            if self.record_class is not None:
+                return self._make_record(results)
             return results
 
+    def _make_record(self, results):
+        interners = self._interners
+        return self.record_class(*[
+            interners[key](results[key]) if key in interners else results[key]
+            for key in self.fieldnames])
+
+    def _generate_build(self, decode=False):
+        """
+        Return a function that does the same as _build_generic for this
+        format, with the group numbers looked up ahead of time and the
+        identity post processors left out, e.g.:
+
+            def build(match):
+                g = match.groups()
+                results = {'remote_host': g[0], 'status': g[2]}
+                results.update(values_func_time_received({'time_received': g[1]}))
+                return results
+
+        For ``record="slots"`` it calls the record class with the values.
+        With ``decode=True`` it's for matches on bytes, and decodes each field.
+        """
+        namespace = {'LazyLogLine': LazyLogLine, 'lazy_derived': self._lazy_derived, 'fieldnames': self.fieldnames}
+        group_refs = {}
+        for name in self.functions_to_parse:
+            group_refs[name] = "g[{0}]".format(self.log_line_regex.groupindex[name] - 1)
+            if decode:
+                group_refs[name] += ".decode({0!r}, {1!r})".format(self.field_encodings.get(name, self.encoding), self.errors)
+        lines = ["def build(match):", "    g = match.groups()"]
+
+        if self.lazy:
+            values = ", ".join("{0!r}: {1}".format(name, group_refs[name]) for name in self._plain_names)
+            raw = ", ".join("{0!r}: {1}".format(name, group_refs[name]) for name in self._lazy_names)
+            lines.append("    return LazyLogLine({{{0}}}, {{{1}}}, lazy_derived, fieldnames)".format(values, raw))
+        elif self.record_class is not None:
+            # Each key's value comes straight from its group, or from the
+            # post processor's results, without building a dict
+            namespace['Record'] = self.record_class
+            refs = {}
+            for name, values_func in self.functions_to_parse.items():
+                if values_func is identity:
+                    refs[name] = group_refs[name]
+                else:
+                    namespace["values_func_"+name] = values_func
+                    lines.append("    values_{0} = values_func_{0}({{{0!r}: {1}}})".format(name, group_refs[name]))
+                    for key in self.derived_names[name]:
+                        refs[key] = "values_{0}[{1!r}]".format(name, key)
+            values = []
+            for key in self.fieldnames:
+                if key in self._interners:
+                    namespace['intern_'+key] = self._interners[key]
+                    values.append("intern_{0}({1})".format(key, refs[key]))
+                else:
+                    values.append(refs[key])
+            lines.append("    return Record({0})".format(", ".join(values)))
+        else:
+            names = list(self.functions_to_parse)
+            # Plain fields up to the first post processor go straight into the dict
+            leading = []
+            while names and self.functions_to_parse[names[0]] is identity:
+                leading.append(names.pop(0))
+            lines.append("    results = {{{0}}}".format(", ".join("{0!r}: {1}".format(name, group_refs[name]) for name in leading)))
+            for name in names:
+                values_func = self.functions_to_parse[name]
+                if values_func is identity:
+                    lines.append("    results[{0!r}] = {1}".format(name, group_refs[name]))
+                else:
+                    namespace["values_func_"+name] = values_func
+                    lines.append("    results.update(values_func_{0}({{{0!r}: {1}}}))".format(name, group_refs[name]))
+            for key in self._unwanted:
+                lines.append("    results.pop({0!r}, None)".format(key))
+            lines.append("    return results")
+
+        source = "\n".join(lines) + "\n"
+        if not decode:
+            self._build_source = source
+        exec(compile(source, "<apache_log_parser build>", "exec"), namespace)
+        return namespace['build']
+
+
+PARSER_CACHE_SIZE = 128
+
+_parser_argspec = getargspec(Parser.__init__)
+# Parser's options, and their defaults
+PARSER_DEFAULTS = dict(zip(_parser_argspec.args[-len(_parser_argspec.defaults):], _parser_argspec.defaults))
+
+_parser_cache = OrderedDict()
+_parser_cache_lock = threading.Lock()
+
+def _parser_cache_key(format_string, kwargs):
+    key = [format_string]
+    for name, value in sorted(kwargs.items()):
+        if isinstance(value, dict):
+            value = tuple(sorted(value.items()))
+        elif isinstance(value, list):
+            value = tuple(value)
+        key.append((name, value))
+    return tuple(key)
+
+def get_parser(format_string, **kwargs):
+    """
+    Return a Parser for format_string & options, from a process wide cache
+    of the PARSER_CACHE_SIZE most recently used ones. The same Parser (with
+    its User-Agent & time caches, and counts) is shared by everyone who asks
+    for the same format string & options.
+
+    It's safe to use that Parser from several threads at once, but then its
+    counts (``lines_matched`` etc., and the ``profile`` stats) may miss some
+    lines. Make a Parser of your own for each thread if they need to be exact.
+    """
+    kwargs = dict(PARSER_DEFAULTS, **kwargs)
+    # So that changing DEFAULT_ENGINE gives a different parser
+    kwargs['engine'] = kwargs['engine'] or DEFAULT_ENGINE
+    if kwargs['filters']:
+        # So that e.g. "404" and Equals("404") give the same parser
+        kwargs['filters'] = dict((name, make_filter(value)) for name, value in kwargs['filters'].items())
+    key = _parser_cache_key(format_string, kwargs)
+    try:
+        hash(key)
+    except TypeError:
+        # Options we can't use as a key
+        return Parser(format_string, **kwargs)
+    with _parser_cache_lock:
+        parser = _parser_cache.pop(key, None)
+        if parser is not None:
+            _parser_cache[key] = parser
+            return parser
+    parser = Parser(format_string, **kwargs)
+    with _parser_cache_lock:
+        _parser_cache[key] = parser
+        while len(_parser_cache) > PARSER_CACHE_SIZE:
+            _parser_cache.popitem(last=False)
+    return parser
+
+def _unpickle_parser(format_string, kwargs):
+    return get_parser(format_string, **kwargs)
+
+def make_parser(format_string, **kwargs):
+    return get_parser(format_string, **kwargs).parse
+
+def get_fieldnames(format_string, fields=None, derived=False):
+    """
+    Return the names of the fields in format_string. With ``derived=True``,
+    return all the keys that parsing a line will give, including derived
+    ones like ``request_url``. ``fields`` is a projection, as for Parser.
+    The line regex isn't compiled.
+    """
+    format_fields_list, trailing = format_fields(format_string)
+    projected = _project(format_string, format_fields_list, fields)
+    if derived:
+        return tuple(key for derived_names in projected for key in derived_names)
+    else:
+        return tuple(field[2] for field, derived_names in zip(format_fields_list, projected) if derived_names)
+
+# Punctuation in a format's literal text that MultiParser counts in a line
+# to rule out formats
+DISCRIMINATING_CHARS = '"[]<>()|;,@#'
+
+def _has_counts(line, counts):
+    for char, count in counts:
+        if line.count(char) < count:
+            return False
+    return True
+
+class MultiParser(object):
+    """
+    Parses lines that may be in any of several format strings, e.g. from
+    servers with different LogFormats writing into the same pipeline.
+
+    Each line is parsed with the first format (see ``order``) that matches
+    the whole line, or failing that, the first in ``format_strings`` whose
+    regex matches the start of it, as ``Parser.parse`` allows. The results
+    are the same as that format's Parser gives. Before a format's regex is
+    tried, the line must start & end with the format's literal text, if it
+    has any, so most wrong formats are ruled out without a regex.
+
+    With ``adaptive=True`` (the default) a format that matched is moved to
+    the front of the order, so runs of lines in the same format only try
+    that one. If a line could be read as more than one of the formats, use
+    ``adaptive=False`` to always try them in the order given.
+
+    ``match_counts`` has the lines matched for each format string. The other
+    keyword arguments are options for each format's Parser (see get_parser).
+    Lines are matched with each format's Parser as it would match them, so
+    with ``filters`` a line that matches a format but fails its filters is
+    still taken to be in that format, and counted in ``lines_filtered``.
+    Lines that don't have the text the filters need in any format that
+    could match them are counted in ``lines_skipped``, as for Parser.
+    """
+
+    def __init__(self, format_strings, adaptive=True, **parser_kwargs):
+        format_strings = tuple(format_strings)
+        if not format_strings:
+            raise ValueError("Need at least one format string")
+        if len(set(format_strings)) != len(format_strings):
+            raise ValueError("Format strings must be different")
+        self.format_strings = format_strings
+        self.adaptive = adaptive
+        self.parsers = tuple(get_parser(format_string, **parser_kwargs) for format_string in format_strings)
+        self.match_counts = OrderedDict((format_string, 0) for format_string in format_strings)
+        self.lines_unmatched = 0
+        self.lines_filtered = 0
+        self.lines_skipped = 0
+        self._patterns = tuple(parser.log_line_regex.pattern for parser in self.parsers)
+
+        # (parser, literal prefix, literal suffix, literal punctuation
+        # counts, match of the whole line, index in format_strings) for each
+        # format, in the order they're tried
+        self._order = []
+        for index, parser in enumerate(self.parsers):
+            format_fields_list, trailing = format_fields(parser.format_string)
+            prefix = format_fields_list[0][0] if format_fields_list else trailing
+            literals = "".join(field[0] for field in format_fields_list) + trailing
+            # Lines in this format have at least as many of each of these
+            # as the format's literal text
+            counts = tuple((char, literals.count(char)) for char in sorted(set(literals)) if char in DISCRIMINATING_CHARS)
+            whole_match = re.compile("(?:" + parser._log_line_regex_raw + r")\Z").match
+            self._order.append((parser, prefix, trailing, counts, whole_match, index))
+
+    @property
+    def order(self):
+        """The format strings, in the order they'll be tried"""
+        return tuple(entry[0].format_string for entry in self._order)
+
+    def _dispatch(self, line):
+        """
+        Return the Parser for this line, and the match (_FILTERED if the
+        line is filtered out), or None and either None or _SKIPPED if a
+        format's filters skipped it without matching it
+        """
+        order = self._order
+        # (index in format_strings, parser, match or None if it hasn't been
+        # tried) for the parsers that could only match the start of the line
+        partial = None
+        skipped = None
+        for index, (parser, prefix, suffix, counts, whole_match, rank) in enumerate(order):
+            if not line.startswith(prefix):
+                continue
+            if counts and not _has_counts(line, counts):
+                continue
+            if not line.endswith(suffix):
+                if partial is None:
+                    partial = []
+                partial.append((rank, parser, None))
+                continue
+            match = parser._match_line(line)
+            if match is None:
+                continue
+            elif match is _SKIPPED:
+                # Filtered out if it's in this format, but it may not be
+                skipped = _SKIPPED
+                continue
+            # Parser.parse only matches as much of the line as it needs,
+            # e.g. a %>s at the end is only matched up to its first digit,
+            # so check that the format could match all of it
+            if (match is not _FILTERED and match.end() == len(line)) or whole_match(line):
+                if index > 0 and self.adaptive:
+                    # A new list, so that other threads never see it half changed
+                    self._order = [order[index]] + order[:index] + order[index+1:]
+                return parser, match
+            if partial is None:
+                partial = []
+            partial.append((rank, parser, match))
+        # Only a match of the start of the line, as Parser.parse allows, with
+        # the first in format_strings whatever the order is now
+        if partial is not None:
+            for rank, parser, match in sorted(partial, key=lambda entry: entry[0]):
+                if match is None:
+                    match = parser._match_line(line)
+                    if match is _SKIPPED:
+                        skipped = _SKIPPED
+                        continue
+                if match is not None:
+                    return parser, match
+        return None, skipped
+
+    def _build(self, parser, match):
+        self.match_counts[parser.format_string] += 1
+        if match is _FILTERED:
+            self.lines_filtered += 1
+            return None
+        return parser._build(match)
+
+    def parse_with_format(self, log_line):
+        """
+        Return the format string that log_line is in, and the results of
+        parsing it (None if it's filtered out). Both are None if it was
+        skipped without finding out which format it's in (see
+        ``lines_skipped``).
+        """
+        parser, match = self._dispatch(log_line)
+        if parser is None:
+            if match is _SKIPPED:
+                self.lines_skipped += 1
+                return None, None
+            self.lines_unmatched += 1
+            raise LineDoesntMatchException(log_line=log_line, regex=self._patterns)
+        return parser.format_string, self._build(parser, match)
+
+    def parse(self, log_line):
+        return self.parse_with_format(log_line)[1]
+
+    def parse_stream(self, lines, on_error='raise'):
+        """
+        As Parser.parse_stream, for lines in any of the formats. The lines
+        must be strings: bytes raise a TypeError.
+        """
+        _check_on_error(on_error)
+        return self._parse_stream(lines, on_error)
+
+    def _parse_stream(self, lines, on_error):
+        dispatch = self._dispatch
+        build = self._build
+        for line in lines:
+            if not isinstance(line, (str, type(u''))):
+                raise TypeError("MultiParser can only parse lines of text, not {0}: open the file in text mode, "
+                                "or decode them first".format(type(line).__name__))
+            line = line.rstrip("\r\n")
+            parser, match = dispatch(line)
+            if parser is not None:
+                results = build(parser, match)
+                if results is not None:
+                    yield results
+            elif match is _SKIPPED:
+                self.lines_skipped += 1
+            else:
+                self.lines_unmatched += 1
+                if on_error == 'skip':
+                    continue
+                elif on_error == 'raise':
+                    raise LineDoesntMatchException(log_line=line, regex=self._patterns)
+                elif on_error == 'yield_error':
+                    yield LineDoesntMatchException(log_line=line, regex=self._patterns)
+                else:
+                    on_error(line)
+
+    def parse_file(self, path, on_error='raise'):
+        """As Parser.parse_file, for lines in any of the formats"""
+        _check_on_error(on_error)
+        return self._parse_file(path, on_error)
 
-def make_parser(format_string):
-    return Parser(format_string).parse
+    def _parse_file(self, path, on_error):
+        parser = self.parsers[0]
+        with open_log_file(path, encoding=parser.encoding, errors=parser.errors) as f:
+            for result in self._parse_stream(f, on_error):
+                yield result
 
-def get_fieldnames(format_string):
-    return Parser(format_string).names
+from apache_log_parser.parallel import parse_file_parallel, parse_file_parallel_batches
+from apache_log_parser.tail import follow, LogFollower
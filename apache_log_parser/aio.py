@@ -0,0 +1,71 @@
+"""
+asyncio versions of the parts of apache_log_parser that wait for things.
+Needs Python 3.5 or later, so it isn't imported by apache_log_parser itself.
+"""
+import asyncio
+import time
+
+from apache_log_parser.tail import LogFollower
+
+# Give the event loop a turn after this many results, so a big backlog of
+# lines that are already there doesn't hold it up until they're all parsed
+YIELD_EVERY = 1000
+
+_DONE = object()
+
+class AsyncLogFollower(LogFollower):
+    """
+    A LogFollower that is an async iterator: ``async for`` gives the results
+    for each line as it's appended, and waits with ``asyncio.sleep`` between
+    polls, so the event loop can get on with other things. Each step reads
+    at most FOLLOW_READ_SIZE bytes of the file, and it lets other tasks run
+    every YIELD_EVERY lines while it works through lines already written.
+    """
+
+    _results = None
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncLogFollower, self).__init__(*args, **kwargs)
+        self._idle_since = time.time()
+        self._since_yield = 0
+
+    def __aiter__(self):
+        self._idle_since = time.time()
+        return self
+
+    async def __anext__(self):
+        while True:
+            if self._results is None:
+                self._results = self.parser.parse_stream(self._lines(), on_error=self.on_error)
+            result = next(self._results, _DONE)
+            if result is not _DONE:
+                self._idle_since = time.time()
+                self._since_yield += 1
+                if self._since_yield >= YIELD_EVERY:
+                    self._since_yield = 0
+                    await asyncio.sleep(0)
+                return result
+            self._results = None
+            self._since_yield = 0
+            # Caught up, so a good time to save where we are
+            self.save_checkpoint()
+            if self.max_idle is not None and time.time() - self._idle_since >= self.max_idle:
+                raise StopAsyncIteration
+            await asyncio.sleep(self.poll_interval)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+def follow_async(path, format_string, **kwargs):
+    """
+    Return an AsyncLogFollower for the log file at ``path``, e.g.:
+
+        async with follow_async("/var/log/apache2/access.log", format, checkpoint_path="access.pos") as lines:
+            async for log_line_data in lines:
+                ...
+    """
+    return AsyncLogFollower(path, format_string, **kwargs)
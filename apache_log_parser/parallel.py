@@ -0,0 +1,236 @@
+"""
+Parse large log files with a pool of worker processes.
+"""
+import io
+import multiprocessing
+from functools import partial
+
+from apache_log_parser import get_parser, LineDoesntMatchException, numpy, _open_binary, _check_on_error
+
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+DEFAULT_BATCH_LINES = 20000
+
+# The Parser in each task is pickled as its format string & options, and
+# unpickled from the parser cache in the worker, so it's only built once per
+# worker process.
+#
+# With build_results false, a worker sends back the groups of each match
+# rather than its results, and this process makes the results from them
+# with _Groups. They're much cheaper to pickle, but making the results is
+# most of the work of parsing a line, so that's only worth it when this
+# process would otherwise be waiting for a single worker.
+
+def _parse_lines(task):
+    parser, on_error, build_results, lines = task
+    build = None if build_results else _match_groups
+    return list(parser._parse_stream(lines, on_error, build))
+
+def _parse_range(task):
+    parser, on_error, build_results, path, start, end = task
+    with io.open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    build = None if build_results else partial(_decoded_groups, _group_encodings(parser), parser.errors)
+    results = parser._parse_buffer(data, on_error, build)
+    if on_error == 'yield_error':
+        # Send the bad lines back as strings, as for the other parse methods
+        results = [_decode_error(parser, x) if isinstance(x, LineDoesntMatchException) else x for x in results]
+    return list(results)
+
+def _batch_lines(task):
+    parser, skip, typed, use_numpy, lines = task
+    bad_lines = []
+    columns = parser.parse_batch(lines, typed=typed, use_numpy=use_numpy,
+                                 on_error='skip' if skip else bad_lines.append)
+    return columns, bad_lines
+
+def _batch_range(task):
+    parser, skip, typed, use_numpy, path, start, end = task
+    with io.open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = data.decode(parser.encoding, parser.errors).split("\n")
+    if not lines[-1]:
+        # After the last newline
+        lines.pop()
+    return _batch_lines((parser, skip, typed, use_numpy, lines))
+
+def _decode_error(parser, error):
+    return LineDoesntMatchException(log_line=error.log_line.decode(parser.encoding, parser.errors), regex=parser.log_line_regex.pattern)
+
+def _match_groups(match):
+    return match.groups()
+
+def _group_encodings(parser):
+    """(index in match.groups(), encoding) for each group the results are made from"""
+    return [(parser.log_line_regex.groupindex[name] - 1, parser.field_encodings.get(name, parser.encoding))
+            for name in parser.functions_to_parse]
+
+def _decoded_groups(encodings, errors, match):
+    groups = match.groups()
+    decoded = [None] * len(groups)
+    for index, encoding in encodings:
+        decoded[index] = groups[index].decode(encoding, errors)
+    return tuple(decoded)
+
+class _Groups(object):
+    """Stands in for the match a worker got these groups from, for Parser._build"""
+
+    def __init__(self, groups, groupindex):
+        self._groups = groups
+        self._groupindex = groupindex
+
+    def groups(self):
+        return self._groups
+
+    def groupdict(self):
+        return dict((name, self._groups[index - 1]) for name, index in self._groupindex.items())
+
+def byte_ranges(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split the file at path into (start, end) byte ranges of about
+    chunk_size bytes, each ending just after a newline (or at the end of the file)
+    """
+    ranges = []
+    with io.open(path, 'rb') as f:
+        start = 0
+        while True:
+            f.seek(start + chunk_size)
+            f.readline()
+            end = f.tell()
+            if end <= start + chunk_size:
+                # Reached the end of the file
+                f.seek(0, io.SEEK_END)
+                end = f.tell()
+                if end > start:
+                    ranges.append((start, end))
+                break
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def _line_batches(f, batch_lines):
+    batch = []
+    for line in f:
+        batch.append(line)
+        if len(batch) >= batch_lines:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def parse_file_parallel(path, format_string, workers=None, ordered=True, on_error='raise',
+                        chunk_size=DEFAULT_CHUNK_SIZE, **parser_kwargs):
+    """
+    Parse the log file at path with a pool of ``workers`` processes (default:
+    one per CPU), yielding the results for each line, like
+    Parser.parse_file. The Parser for format_string and ``parser_kwargs`` is
+    rebuilt in each worker.
+
+    Uncompressed files are split into byte ranges of about ``chunk_size``
+    bytes, aligned to line ends, which the workers read and parse as bytes
+    (see Parser.parse_mmap). Compressed
+    files are read by this process, and batches of lines are sent to the
+    workers.
+
+    With ``ordered=False``, results come back in whatever order the workers
+    finish, which is faster. ``on_error`` is as for Parser.parse_stream; a
+    function is called in this process.
+
+    With one worker, it only matches the lines, and the post processors are
+    run in this process, so that the two take turns less.
+    """
+    _check_on_error(on_error)
+    if parser_kwargs.get('lazy'):
+        raise ValueError("Lazy results can't be sent between processes")
+    parser = get_parser(format_string, **parser_kwargs)
+    workers = workers or multiprocessing.cpu_count()
+    worker_on_error = 'skip' if on_error == 'skip' else 'yield_error'
+    build_results = workers > 1
+
+    f, compressed = _open_binary(path)
+    if compressed:
+        text = io.TextIOWrapper(f, encoding=parser.encoding, errors=parser.errors)
+        func = _parse_lines
+        tasks = ((parser, worker_on_error, build_results, batch) for batch in _line_batches(text, DEFAULT_BATCH_LINES))
+    else:
+        f.close()
+        func = _parse_range
+        tasks = [(parser, worker_on_error, build_results, path, start, end)
+                 for start, end in byte_ranges(path, chunk_size)]
+
+    build = None if build_results else parser._build
+    return _parse_parallel(parser, func, tasks, workers, ordered, on_error, build, f)
+
+def _parse_parallel(parser, func, tasks, workers, ordered, on_error, build, f):
+    groupindex = parser.log_line_regex.groupindex
+    pool = multiprocessing.Pool(workers)
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for results in imap(func, tasks):
+            for result in results:
+                if isinstance(result, LineDoesntMatchException):
+                    if on_error == 'raise':
+                        raise result
+                    elif callable(on_error):
+                        on_error(result.log_line)
+                        continue
+                elif build is not None:
+                    result = build(_Groups(result, groupindex))
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        f.close()
+
+def parse_file_parallel_batches(path, format_string, workers=None, ordered=True, on_error='raise',
+                                chunk_size=DEFAULT_CHUNK_SIZE, typed=True, use_numpy=None, **parser_kwargs):
+    """
+    Like parse_file_parallel, but yielding a dict of columns for each chunk
+    of the file, as Parser.parse_batch returns for its lines: the captured
+    fields, without post processing, and with ``typed=True`` the numbers
+    and times as arrays. These are far cheaper to send back from the
+    workers than a dict for each line, so this keeps up with more workers.
+
+    ``on_error`` is "raise", "skip" or a function, called in this process
+    with each bad line of a chunk before that chunk's columns are yielded.
+    """
+    if on_error == 'yield_error':
+        raise ValueError("on_error can't be 'yield_error' for parse_file_parallel_batches")
+    _check_on_error(on_error)
+    parser = get_parser(format_string, **parser_kwargs)
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise ImportError("NumPy isn't installed")
+    workers = workers or multiprocessing.cpu_count()
+    skip = on_error == 'skip'
+
+    f, compressed = _open_binary(path)
+    if compressed:
+        text = io.TextIOWrapper(f, encoding=parser.encoding, errors=parser.errors)
+        func = _batch_lines
+        tasks = ((parser, skip, typed, use_numpy, batch) for batch in _line_batches(text, DEFAULT_BATCH_LINES))
+    else:
+        f.close()
+        func = _batch_range
+        tasks = [(parser, skip, typed, use_numpy, path, start, end)
+                 for start, end in byte_ranges(path, chunk_size)]
+
+    return _parse_parallel_batches(parser, func, tasks, workers, ordered, on_error, f)
+
+def _parse_parallel_batches(parser, func, tasks, workers, ordered, on_error, f):
+    pool = multiprocessing.Pool(workers)
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for columns, bad_lines in imap(func, tasks):
+            for line in bad_lines:
+                if on_error == 'raise':
+                    raise LineDoesntMatchException(log_line=line, regex=parser.log_line_regex.pattern)
+                on_error(line)
+            yield columns
+    finally:
+        pool.terminate()
+        pool.join()
+        f.close()
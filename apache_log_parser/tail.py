@@ -0,0 +1,266 @@
+"""
+Follow a log file as lines are appended to it, like ``tail -F``.
+"""
+import errno
+import io
+import json
+import os
+import time
+
+from apache_log_parser import get_parser, _check_on_error
+
+DEFAULT_POLL_INTERVAL = 1.0
+
+# How much of the file is read at a time
+FOLLOW_READ_SIZE = 1024 * 1024
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+def _same_file(stat, checkpoint):
+    return stat is not None and (stat.st_dev, stat.st_ino) == (checkpoint.get('dev'), checkpoint.get('inode'))
+
+def load_checkpoint(path):
+    """Return the checkpoint saved in the file at path, or None if there isn't one"""
+    try:
+        with io.open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+def save_checkpoint(checkpoint, path):
+    """Save checkpoint to the file at path, replacing it in one step"""
+    tmp_path = path + '.tmp'
+    with io.open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(type(u'')(json.dumps(checkpoint)))
+    if hasattr(os, 'replace'):
+        os.replace(tmp_path, path)
+    else:
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+
+class LogFollower(object):
+    """
+    Parses the lines appended to the log file at ``path``. ``poll`` returns
+    the results for the complete lines written since the last call, and
+    iterating blocks, checking the file every ``poll_interval`` seconds,
+    until it's been idle for ``max_idle`` seconds (forever by default).
+    ``apache_log_parser.aio.follow_async`` is the asyncio version.
+
+    When the file at ``path`` is replaced by another (e.g. logrotate renamed
+    it), which is noticed from its inode, the rest of the old file is read
+    first. If it's truncated (logrotate's copytruncate) it's read again from
+    the start.
+
+    ``checkpoint`` is where it's got to: the file's device & inode and the
+    byte offset just after the last line that has been parsed (i.e. the line
+    whose results were last returned). Passing it back in (or
+    ``checkpoint_path``, a file it is loaded from and saved to whenever the
+    follower has caught up, and when it's closed) carries on from there
+    without parsing anything twice. If the file was rotated in the meantime,
+    the old one is looked for next to it (e.g. ``access.log.1``). Without a
+    checkpoint, it starts at the end of the file, or the start with
+    ``from_start=True``.
+
+    ``on_error`` is as for Parser.parse_stream, and the other keyword
+    arguments are options for the Parser.
+    """
+
+    def __init__(self, path, format_string, checkpoint=None, checkpoint_path=None,
+                 from_start=False, poll_interval=DEFAULT_POLL_INTERVAL, max_idle=None,
+                 on_error='raise', **parser_kwargs):
+        _check_on_error(on_error)
+        self.path = path
+        self.parser = get_parser(format_string, **parser_kwargs)
+        self.checkpoint_path = checkpoint_path
+        self.poll_interval = poll_interval
+        self.max_idle = max_idle
+        self.on_error = on_error
+        self.rotations = 0
+        self.truncations = 0
+
+        self._file = None
+        # os.fstat() of self._file, to tell when path is a different file
+        self._file_stat = None
+        # Where the next line starts
+        self._offset = 0
+        # The end of the file after the last newline, an incomplete line
+        self._partial = b""
+        self._saved_checkpoint = None
+
+        if checkpoint is None and checkpoint_path is not None:
+            checkpoint = load_checkpoint(checkpoint_path)
+            self._saved_checkpoint = checkpoint
+        if checkpoint is not None:
+            self._restore(checkpoint)
+        else:
+            self._open(seek_end=not from_start)
+
+    def _open(self, seek_end=False, offset=0):
+        try:
+            f = io.open(self.path, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                # Not there (yet), keep looking for it
+                return
+            raise
+        self._file_stat = os.fstat(f.fileno())
+        if seek_end:
+            offset = self._file_stat.st_size
+        f.seek(offset)
+        self._file, self._offset, self._partial = f, offset, b""
+
+    def _restore(self, checkpoint):
+        stat = _stat(self.path)
+        if _same_file(stat, checkpoint):
+            if stat.st_size < checkpoint['offset']:
+                self.truncations += 1
+                self._open()
+            else:
+                self._open(offset=checkpoint['offset'])
+            return
+
+        # Rotated since the checkpoint, so look for the old file next to it.
+        # Once that's been read, it will be noticed that path is a different
+        # file, as for any other rotation.
+        directory, basename = os.path.split(self.path)
+        for name in sorted(os.listdir(directory or os.curdir)):
+            old_path = os.path.join(directory, name)
+            if name != basename and name.startswith(basename) and _same_file(_stat(old_path), checkpoint):
+                f = io.open(old_path, 'rb')
+                f.seek(checkpoint['offset'])
+                self._file_stat = os.fstat(f.fileno())
+                self._file, self._offset, self._partial = f, checkpoint['offset'], b""
+                return
+        self._open()
+
+    @property
+    def checkpoint(self):
+        if self._file_stat is None:
+            # The file has never been there
+            return None
+        return {'path': self.path, 'dev': self._file_stat.st_dev, 'inode': self._file_stat.st_ino, 'offset': self._offset}
+
+    def save_checkpoint(self):
+        """Save the checkpoint to ``checkpoint_path``, if it has changed"""
+        checkpoint = self.checkpoint
+        if self.checkpoint_path is None or checkpoint is None or checkpoint == self._saved_checkpoint:
+            return
+        save_checkpoint(checkpoint, self.checkpoint_path)
+        self._saved_checkpoint = checkpoint
+
+    def _read_lines(self):
+        """Yield each complete line that can be read now"""
+        # A previous pass may have been abandoned part way through what it
+        # read, so start again from the end of the last line returned
+        self._file.seek(self._offset)
+        self._partial = b""
+        while True:
+            data = self._file.read(FOLLOW_READ_SIZE)
+            if not data:
+                return
+            data = self._partial + data
+            end = data.rfind(b"\n") + 1
+            self._partial = data[end:]
+            if end == 0:
+                continue
+            for line in data[:end - 1].split(b"\n"):
+                # Moved on before the results are returned, so that a
+                # checkpoint taken after them doesn't include this line again
+                self._offset += len(line) + 1
+                yield line
+
+    def _reopen(self):
+        """
+        At the end of the file: open the file at path again if it's been
+        replaced or truncated. Returns "rotated", "truncated" or None.
+        """
+        stat = _stat(self.path)
+        if stat is None:
+            # Renamed, and the new file isn't there yet. Keep reading the
+            # old one, which may still be written to until then.
+            return None
+        if (stat.st_dev, stat.st_ino) != (self._file_stat.st_dev, self._file_stat.st_ino):
+            self.rotations += 1
+            self._close_file()
+            self._open()
+            return 'rotated'
+        if stat.st_size < self._file.tell():
+            self.truncations += 1
+            self._close_file()
+            self._open()
+            return 'truncated'
+        return None
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _lines(self):
+        encoding, errors = self.parser.encoding, self.parser.errors
+        while True:
+            if self._file is None:
+                self._open()
+                if self._file is None:
+                    return
+            for line in self._read_lines():
+                yield line.decode(encoding, errors)
+            partial = self._partial
+            reopened = self._reopen()
+            if reopened is None:
+                return
+            if reopened == 'rotated' and partial:
+                # The old file's last line, which will never get its newline
+                yield partial.decode(encoding, errors)
+
+    def poll(self):
+        """Return the results for all the lines that can be read now"""
+        return list(self.parser.parse_stream(self._lines(), on_error=self.on_error))
+
+    def __iter__(self):
+        idle_since = time.time()
+        while True:
+            got_lines = False
+            for result in self.parser.parse_stream(self._lines(), on_error=self.on_error):
+                got_lines = True
+                yield result
+            if got_lines:
+                idle_since = time.time()
+            # Caught up, so a good time to save where we are
+            self.save_checkpoint()
+            if self.max_idle is not None and time.time() - idle_since >= self.max_idle:
+                return
+            time.sleep(self.poll_interval)
+
+    def close(self):
+        """Save the checkpoint and close the file"""
+        self.save_checkpoint()
+        self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def follow(path, format_string, **kwargs):
+    """
+    Return a LogFollower for the log file at ``path``, which yields the
+    results for each line as it's appended, e.g.:
+
+        with follow("/var/log/apache2/access.log", format, checkpoint_path="access.pos") as lines:
+            for log_line_data in lines:
+                ...
+    """
+    return LogFollower(path, format_string, **kwargs)
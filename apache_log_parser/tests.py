@@ -1,9 +1,28 @@
 
 import unittest
+import array
 import apache_log_parser
 import datetime
 import doctest
 import os.path
+import pickle
+import bz2
+import gzip
+import io
+import shutil
+import sys
+import tempfile
+import threading
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import pathlib
+except ImportError:
+    pathlib = None
 
 class ApacheLogParserTestCase(unittest.TestCase):
     maxDiff = None
@@ -131,9 +150,649 @@ class ApacheLogParserTestCase(unittest.TestCase):
         sample1 = '10.178.98.112 2607:5300:60:2c74:: - - [24/Mar/2015:16:40:45 -0400] "GET /category/blog/page/3 HTTP/1.0" 200 41207 "-" "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/534.30 (KHTML, like Gecko) Ubuntu/10.10 Chromium/12.0.742.112 Chrome/12.0.742.112 Safari/534.30"'
         log_data1 = parser(sample1)
 
+    def test_user_agent_cache(self):
+        parser = apache_log_parser.Parser("%h \"%{User-Agent}i\"", user_agent_cache_size=2)
+        firefox = 'Mozilla/5.0 (X11; Linux x86_64; rv:29.0) Gecko/20100101 Firefox/29.0'
+        chrome = 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2062.120 Safari/537.36'
+        data1 = parser.parse('127.0.0.1 "{0}"'.format(firefox))
+        data1['request_header_user_agent__browser__family'] = 'changed'
+        data2 = parser.parse('127.0.0.2 "{0}"'.format(firefox))
+        self.assertEqual(data2['request_header_user_agent__browser__family'], 'Firefox')
+        parser.parse('127.0.0.1 "{0}"'.format(chrome))
+        parser.parse('127.0.0.1 "curl/7.35.0"')
+        self.assertEqual(parser.user_agent_cache.stats(), {'hits': 1, 'misses': 3, 'evictions': 1, 'size': 2, 'maxsize': 2})
+
+        uncached = apache_log_parser.Parser("%h \"%{User-Agent}i\"", user_agent_cache_size=None)
+        self.assertEqual(uncached.user_agent_cache, None)
+        self.assertEqual(uncached.parse('127.0.0.2 "{0}"'.format(firefox)), data2)
+
+        # Shared between threads
+        cache = apache_log_parser.UserAgentCache(maxsize=1)
+        errors = []
+        def get_all():
+            try:
+                for i in range(200):
+                    self.assertEqual(dict(cache.get((firefox, chrome)[i % 2]))['request_header_user_agent__browser__family'], ('Firefox', 'Chrome')[i % 2])
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=get_all) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        stats = cache.stats()
+        self.assertEqual((stats['hits'] + stats['misses'], stats['size']), (800, 1))
+
+    def test_time_cache(self):
+        cache = apache_log_parser.TimeCache(maxsize=2)
+        for time_received in ['[08/Mar/2015:18:06:58 -0400]', '[08/Mar/2015:18:06:58 -0400]', '[16/Aug/2013:15:45:34 +0000]',
+                              '[08/Mar/2015:18:06:58 -0400]', '[10/Oct/2000:13:55:36 -0700]', '[10/Oct/2000:13:55:36 -0700]']:
+            matched_strings = {'time_received': time_received}
+            self.assertEqual(apache_log_parser.format_time(matched_strings, cache), apache_log_parser.format_time(matched_strings))
+        self.assertEqual(len(cache), 1)
+
+        first = apache_log_parser.format_time({'time_received': '[08/Mar/2015:18:06:58 -0400]'}, cache)
+        first['time_received_isoformat'] = 'changed'
+        second = apache_log_parser.format_time({'time_received': '[08/Mar/2015:18:06:58 -0400]'}, cache)
+        self.assertEqual(second['time_received_isoformat'], '2015-03-08T18:06:58')
+
+    def test_fixed_offset_shared(self):
+        a = apache_log_parser.apachetime('[08/Mar/2015:18:06:58 -0400]')
+        b = apache_log_parser.apachetime('[10/Oct/2000:13:55:36 -0400]')
+        self.assertTrue(a.tzinfo is b.tzinfo)
+        self.assertEqual(a.utcoffset(), datetime.timedelta(hours=-4))
+
+    def test_fields(self):
+        format_string = "%h <<%P>> %t %Dus \"%r\" %>s %b  \"%{Referer}i\" \"%{User-Agent}i\" %l %u"
+        sample = '127.0.0.1 <<6113>> [16/Aug/2013:15:45:34 +0000] 1966093us "GET / HTTP/1.1" 200 3478  "https://example.com/" "Mozilla/5.0 (X11; U; Linux x86_64; en-US; rv:1.9.2.18)" - -'
+        parser = apache_log_parser.Parser(format_string, fields=['status', 'request_url'])
+        self.assertEqual(parser.parse(sample), {'status': '200', 'request_url': '/'})
+        self.assertEqual(list(parser.log_line_regex.groupindex), ['request_first_line', 'status'])
+        self.assertEqual(parser.user_agent_cache.stats()['misses'], 0)
+
+        self.assertEqual(apache_log_parser.get_fieldnames(format_string, fields=['status', 'time_received_isoformat']), ('time_received', 'status'))
+        self.assertEqual(apache_log_parser.get_fieldnames(format_string, fields=['status', 'time_received_isoformat'], derived=True), ('time_received_isoformat', 'status'))
+        self.assertEqual(apache_log_parser.get_fieldnames("%>s \"%r\"", derived=True), ('status', 'request_first_line', 'request_method', 'request_url', 'request_http_ver'))
+
+        self.assertRaises(ValueError, apache_log_parser.Parser, format_string, fields=['status', 'nonsense'])
+
+    def test_lazy(self):
+        format_string = "%h <<%P>> %t %Dus \"%r\" %>s %b  \"%{Referer}i\" \"%{User-Agent}i\" %l %u"
+        sample = '127.0.0.1 <<6113>> [16/Aug/2013:15:45:34 +0000] 1966093us "GET / HTTP/1.1" 200 3478  "https://example.com/" "Mozilla/5.0 (X11; U; Linux x86_64; en-US; rv:1.9.2.18)" - -'
+        parser = apache_log_parser.Parser(format_string, lazy=True)
+        log_data = parser.parse(sample)
+        self.assertEqual(log_data['status'], '200')
+        self.assertEqual(log_data['request_header_user_agent'], 'Mozilla/5.0 (X11; U; Linux x86_64; en-US; rv:1.9.2.18)')
+        self.assertEqual(parser.user_agent_cache.stats()['misses'], 0)
+        self.assertEqual(log_data['request_header_user_agent__os__family'], 'Linux')
+        self.assertEqual(parser.user_agent_cache.stats()['misses'], 1)
+        self.assertEqual(log_data, apache_log_parser.make_parser(format_string)(sample))
+        self.assertEqual(sorted(log_data), sorted(parser.fieldnames))
+
+        parser = apache_log_parser.Parser(format_string, fields=['time_received_utc_isoformat', 'status'], lazy=True)
+        log_data = parser.parse(sample)
+        self.assertEqual(dict(log_data), {'status': '200', 'time_received_utc_isoformat': '2013-08-16T15:45:34+00:00'})
+        self.assertRaises(KeyError, lambda: log_data['time_received_isoformat'])
+
     def test_doctest_readme(self):
         doctest.testfile("../README.md")
 
+    def test_parse_stream(self):
+        parser = apache_log_parser.Parser("%h %l %u %t \"%r\" %>s %b")
+        lines = ['127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326\n', 'garbage\r\n',
+                 '127.0.0.1 - - [10/Oct/2000:13:55:37 -0700] "GET / HTTP/1.0" 404 -\n']
+
+        results = list(parser.parse_stream(lines, on_error='skip'))
+        self.assertEqual([x['status'] for x in results], ['200', '404'])
+        self.assertEqual(results[1]['response_bytes_clf'], '-')
+        self.assertEqual((parser.lines_matched, parser.lines_unmatched), (2, 1))
+
+        results = list(parser.parse_stream(lines, on_error='yield_error'))
+        self.assertTrue(isinstance(results[1], apache_log_parser.LineDoesntMatchException))
+        self.assertEqual(results[1].log_line, 'garbage')
+
+        bad_lines = []
+        self.assertEqual(len(list(parser.parse_stream(lines, on_error=bad_lines.append))), 2)
+        self.assertEqual(bad_lines, ['garbage'])
+
+        self.assertRaises(apache_log_parser.LineDoesntMatchException, list, parser.parse_stream(lines))
+        self.assertRaises(ValueError, parser.parse_stream, lines, on_error='ignore')
+
+        # A file opened in binary mode
+        results = list(parser.parse_stream(io.BytesIO(''.join(lines).encode('utf-8')), on_error='yield_error'))
+        self.assertEqual(results[0], parser.parse(lines[0]))
+        self.assertEqual(results[1].log_line, b'garbage')
+        self.assertEqual(results[2], parser.parse(lines[2]))
+        self.assertEqual(list(parser.parse_stream(iter([]))), [])
+
+    def test_parse_file(self):
+        parser = apache_log_parser.Parser("%h %l %u %t \"%r\" %>s %b")
+        lines = ''.join('127.0.0.1 - - [10/Oct/2000:13:55:{0:02d} -0700] "GET /{0} HTTP/1.0" 200 {0}\n'.format(i) for i in range(60))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            openers = [open, gzip.open, bz2.open]
+            # Python 2 has no lzma, and it's optional in Python 3 builds
+            if lzma is not None:
+                openers.append(lzma.open)
+            for opener in openers:
+                path = os.path.join(tmpdir, 'access.log')
+                with opener(path, 'wt') as f:
+                    f.write(lines)
+                results = list(parser.parse_file(path))
+                self.assertEqual(len(results), 60)
+                self.assertEqual(results[-1]['request_url'], '/59')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parse_file_parallel(self):
+        format_string = "%h %l %u %t \"%r\" %>s %b"
+        lines = ''.join('127.0.0.1 - - [10/Oct/2000:13:55:{0:02d} -0700] "GET /{1} HTTP/1.0" 200 {1}\n'.format(i % 60, i) for i in range(1000))
+        lines += 'garbage\n127.0.0.1 - - [10/Oct/2000:13:56:00 -0700] "GET /last HTTP/1.0" 200 1'
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for opener in [open, gzip.open]:
+                path = os.path.join(tmpdir, 'access.log')
+                with opener(path, 'wt') as f:
+                    f.write(lines)
+                expected = list(apache_log_parser.Parser(format_string).parse_file(path, on_error='skip'))
+                self.assertEqual(len(expected), 1001)
+                for workers in [1, 2]:
+                    results = list(apache_log_parser.parse_file_parallel(path, format_string, workers=workers, chunk_size=1000, on_error='skip'))
+                    self.assertEqual(results, expected)
+                results = apache_log_parser.parse_file_parallel(path, format_string, workers=2, chunk_size=1000, ordered=False, on_error='skip')
+                self.assertEqual(sorted(x['request_url'] for x in results), sorted(x['request_url'] for x in expected))
+                self.assertRaises(apache_log_parser.LineDoesntMatchException, list,
+                                  apache_log_parser.parse_file_parallel(path, format_string, workers=2, chunk_size=1000))
+                results = list(apache_log_parser.parse_file_parallel(path, format_string, workers=1, chunk_size=1000, on_error='yield_error'))
+                self.assertEqual(results[1000].log_line, 'garbage')
+                self.assertEqual(results[:1000] + results[1001:], expected)
+
+                parser = apache_log_parser.Parser(format_string)
+                with opener(path, 'rt') as f:
+                    expected = parser.parse_batch(f, use_numpy=False, on_error='skip')
+                bad_lines = []
+                batches = list(apache_log_parser.parse_file_parallel_batches(path, format_string, workers=2, chunk_size=1000,
+                                                                             use_numpy=False, on_error=bad_lines.append))
+                self.assertEqual(bad_lines, ['garbage'])
+                self.assertEqual(dict((name, sum((batch[name] for batch in batches[1:]), batches[0][name])) for name in expected), expected)
+                self.assertRaises(apache_log_parser.LineDoesntMatchException, list,
+                                  apache_log_parser.parse_file_parallel_batches(path, format_string, workers=2, chunk_size=1000))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_byte_ranges(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'access.log')
+            with open(path, 'wb') as f:
+                f.write(b'a' * 10 + b'\n' + b'b' * 3 + b'\n' + b'c' * 20)
+            self.assertEqual(apache_log_parser.parallel.byte_ranges(path, chunk_size=2), [(0, 11), (11, 15), (15, 35)])
+            self.assertEqual(apache_log_parser.parallel.byte_ranges(path, chunk_size=100), [(0, 35)])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parse_bytes(self):
+        format_string = "%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\""
+        sample = b'127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET /caf\xc3\xa9 HTTP/1.0" 200 2326 "-" "bot \xff\xfe"'
+        parser = apache_log_parser.Parser(format_string)
+        data = parser.parse_bytes(sample)
+        self.assertEqual(data['request_url'], u'/caf\xe9')
+        self.assertEqual(data['request_header_user_agent'], u'bot \ufffd\ufffd')
+        self.assertEqual(data, parser.parse(sample.decode('utf-8', 'replace')))
+
+        parser = apache_log_parser.Parser(format_string, fields=['request_url', 'request_header_user_agent'], lazy=True,
+                                          errors='strict', field_encodings={'request_header_user_agent': 'latin-1'})
+        self.assertEqual(dict(parser.parse_bytes(sample)), {'request_url': u'/caf\xe9', 'request_header_user_agent': u'bot \xff\xfe'})
+        self.assertRaises(apache_log_parser.LineDoesntMatchException, parser.parse_bytes, b'garbage')
+
+    def test_parse_mmap(self):
+        parser = apache_log_parser.Parser("%h %l %u %t \"%r\" %>s %b")
+        lines = b'127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET /a HTTP/1.0" 200 1\r\ngarbage\n\n127.0.0.1 - - [10/Oct/2000:13:55:37 -0700] "GET /b HTTP/1.0" 404 -'
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'access.log')
+            with open(path, 'wb') as f:
+                f.write(lines)
+            bad_lines = []
+            results = list(parser.parse_mmap(path, on_error=bad_lines.append))
+            self.assertEqual(results, [parser.parse(x) for x in lines.decode('ascii').splitlines() if x.startswith('127')])
+            self.assertEqual(bad_lines, [b'garbage', b''])
+            self.assertEqual((parser.lines_matched, parser.lines_unmatched), (2, 2))
+            self.assertRaises(apache_log_parser.LineDoesntMatchException, list, parser.parse_mmap(path))
+            if pathlib is not None:
+                self.assertEqual(list(parser.parse_mmap(pathlib.Path(path), on_error='skip')), results)
+
+            open(path, 'wb').close()
+            self.assertEqual(list(parser.parse_mmap(path)), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parse_batch(self):
+        parser = apache_log_parser.Parser("%h %l %u %t \"%r\" %>s %b %D")
+        lines = ['127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET /a HTTP/1.0" 200 2326 10\n', 'garbage\n',
+                 '127.0.0.2 - - [10/Oct/2000:13:55:37 -0700] "GET /b HTTP/1.0" - - 20\n']
+        columns = parser.parse_batch(lines, use_numpy=False, on_error='skip')
+        self.assertEqual(columns['remote_host'], ['127.0.0.1', '127.0.0.2'])
+        self.assertEqual(columns['request_first_line'], ['GET /a HTTP/1.0', 'GET /b HTTP/1.0'])
+        self.assertEqual(columns['status'], array.array('h', [200, apache_log_parser.MISSING_INT]))
+        self.assertEqual(columns['response_bytes_clf'], array.array('q', [2326, apache_log_parser.MISSING_INT]))
+        self.assertEqual(columns['time_us'], array.array('q', [10, 20]))
+        self.assertEqual(columns['time_received'], array.array('q', [971211336, 971211337]))
+
+        columns = parser.parse_batch(lines, typed=False, on_error='skip')
+        self.assertEqual(columns['status'], ['200', '-'])
+        self.assertRaises(apache_log_parser.LineDoesntMatchException, parser.parse_batch, lines)
+
+        batches = list(parser.parse_batches(lines * 3, batch_size=4, use_numpy=False, on_error='skip'))
+        self.assertEqual([len(x['status']) for x in batches], [3, 2, 1])
+
+        # Too big for the column's type
+        columns = parser.parse_batch(['127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET /a HTTP/1.0" 99999 ' + '9' * 23 + ' 10'], use_numpy=False)
+        self.assertEqual(columns['status'], array.array('h', [apache_log_parser.MISSING_INT]))
+        self.assertEqual(columns['response_bytes_clf'], array.array('q', [apache_log_parser.MISSING_INT]))
+        self.assertEqual(columns['time_us'], array.array('q', [10]))
+
+        # Timezones with minutes
+        columns = parser.parse_batch(['127.0.0.1 - - [10/Oct/2000:13:55:36 +0530] "GET /a HTTP/1.0" 200 1 10',
+                                      '127.0.0.1 - - [10/Oct/2000:13:55:36 -0930] "GET /a HTTP/1.0" 200 1 10'], use_numpy=False)
+        self.assertEqual(columns['time_received'], array.array('q', [971166336, 971220336]))
+        time_range = apache_log_parser.TimeRange(971166336, 971166337)
+        self.assertTrue(time_range.test('[10/Oct/2000:08:25:36 +0000]'))
+        self.assertTrue(time_range.test('[10/Oct/2000:13:55:36 +0530]'))
+        self.assertFalse(time_range.test('[10/Oct/2000:13:55:36 +0500]'))
+
+    @unittest.skipIf(apache_log_parser.numpy is None, "NumPy isn't installed")
+    def test_parse_batch_numpy(self):
+        parser = apache_log_parser.Parser("%h %>s %b", fields=['status', 'response_bytes_clf'])
+        columns = parser.parse_batch(['127.0.0.1 200 2326', '127.0.0.1 404 -'])
+        self.assertEqual(columns['status'].dtype, apache_log_parser.numpy.int16)
+        self.assertEqual(columns['status'].tolist(), [200, 404])
+        self.assertEqual(columns['response_bytes_clf'].tolist(), [2326, apache_log_parser.MISSING_INT])
+
+    def test_tight_regex(self):
+        format_string = "%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\" %D"
+        parser = apache_log_parser.Parser(format_string)
+        self.assertTrue(apache_log_parser.DELIMITED_FIELD_REGEX.format('\\ ') in parser.log_line_regex.pattern)
+        self.assertTrue(apache_log_parser.DELIMITED_FIELD_REGEX.format('\\ "') in parser.log_line_regex.pattern)
+        self.assertTrue("(?P<remote_host>\\S*)" in parser.log_line_regex.pattern)
+        # %u may have spaces
+        self.assertTrue("(?P<remote_user>.*?)" in parser.log_line_regex.pattern)
+
+        data = parser.parse('127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET /\\"quoted\\" HTTP/1.1" 200 1 "-" "Agent \\"1.0\\" \\\\" 10')
+        self.assertEqual(data['request_url'], '/\\"quoted\\"')
+        self.assertEqual(data['request_header_user_agent'], 'Agent \\"1.0\\" \\\\')
+        self.assertEqual(data['time_us'], '10')
+
+        # Unescaped " and \\ in quoted fields
+        line = '127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "{0}" 200 1 "{1}" "{2}" 10'
+        data = parser.parse(line.format('GET /a"b HTTP/1.1', 'http://x/"y', 'Agent \\'))
+        self.assertEqual(data['request_url'], '/a"b')
+        self.assertEqual(data['request_header_referer'], 'http://x/"y')
+        self.assertEqual(data['request_header_user_agent'], 'Agent \\')
+        self.assertEqual(data['time_us'], '10')
+        data = apache_log_parser.Parser("%h \"%{User-Agent}i\"").parse('127.0.0.1 "Agent \\"')
+        self.assertEqual(data['request_header_user_agent'], 'Agent \\')
+
+        # An unescaped " followed by what comes after the field always closes it
+        common = apache_log_parser.Parser("%h %l %u %t \"%r\" %>s %b")
+        self.assertRaises(apache_log_parser.LineDoesntMatchException, common.parse,
+                          '127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET /a" b HTTP/1.1" 200 5')
+
+        # Only the start of the line has to match, so the last field ends at the first "
+        combined = apache_log_parser.Parser("%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\"")
+        data = combined.parse('127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.1" 200 1 "ref" "Mozilla/5.0" "extra" 123')
+        self.assertEqual(data['request_header_user_agent'], 'Mozilla/5.0')
+        self.assertEqual(data['request_header_referer'], 'ref')
+
+        # This takes minutes with ".*?" for every field
+        self.assertRaises(apache_log_parser.LineDoesntMatchException, parser.parse,
+                          '127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET /' + '" 2 "' * 1000)
+
+    def test_request_first_line(self):
+        for first_line, method, url, http_ver in [
+                ('GET / HTTP/1.1', 'GET', '/', '1.1'),
+                ('GET /a b  HTTP/1.0', 'GET', '/a b', '1.0'),
+                ('GET /HTTP/1.1', 'GET', '/HTTP/1.1', None),
+                ('POST  /x', 'POST', ' /x', None),
+                ('GET /' + ' ' * 20000 + 'x', '', '', ''),
+                ('garbage', '', '', '')]:
+            self.assertEqual(apache_log_parser.extra_request_from_first_line({'request_first_line': first_line}),
+                             {'request_first_line': first_line, 'request_method': method, 'request_url': url, 'request_http_ver': http_ver})
+
+    def test_parser_cache(self):
+        format_string = "%h %l %u %t \"%r\" %>s %b"
+        self.assertTrue(apache_log_parser.get_parser(format_string) is apache_log_parser.get_parser(format_string))
+        self.assertTrue(apache_log_parser.make_parser(format_string).__self__ is apache_log_parser.get_parser(format_string))
+        self.assertTrue(apache_log_parser.get_parser(format_string, fields=['status']) is apache_log_parser.get_parser(format_string, fields=('status',)))
+        self.assertFalse(apache_log_parser.get_parser(format_string, lazy=True) is apache_log_parser.get_parser(format_string))
+
+    def test_get_fieldnames_doesnt_compile(self):
+        format_string = "%h %l %u %t \"%r\" %>s %b"
+        parser_class, apache_log_parser.Parser = apache_log_parser.Parser, None
+        try:
+            self.assertEqual(apache_log_parser.get_fieldnames(format_string), ('remote_host', 'remote_logname', 'remote_user', 'time_received', 'request_first_line', 'status', 'response_bytes_clf'))
+            self.assertRaises(ValueError, apache_log_parser.get_fieldnames, format_string, fields=['nonsense'])
+        finally:
+            apache_log_parser.Parser = parser_class
+
+    def test_pickle_parser(self):
+        format_string = "%h %l %u %t \"%r\" %>s %b"
+        sample = '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326'
+        parser = apache_log_parser.get_parser(format_string, fields=['status', 'time_received_tz_datetimeobj'])
+        self.assertTrue(pickle.loads(pickle.dumps(parser)) is parser)
+
+        parser = apache_log_parser.Parser(format_string, lazy=True, user_agent_cache_size=None)
+        unpickled = pickle.loads(pickle.dumps(parser))
+        self.assertEqual((unpickled.lazy, unpickled.user_agent_cache), (True, None))
+        self.assertEqual(unpickled.parse(sample), parser.parse(sample))
+        self.assertEqual(pickle.loads(pickle.dumps(dict(parser.parse(sample)))), parser.parse(sample))
+
+    def test_engines(self):
+        format_string = "%h <<%P>> %t %Dus \"%r\" %>s %b  \"%{Referer}i\" \"%{User-Agent}i\" %l %u"
+        sample = '127.0.0.1 <<6113>> [16/Aug/2013:15:45:34 +0000] 1966093us "GET / HTTP/1.1" 200 3478  "https://example.com/" "Mozilla/5.0 (X11; U; Linux x86_64; en-US; rv:1.9.2.18)" - -'
+        for kwargs in [{}, {'fields': ['status', 'request_url', 'time_received_isoformat']}, {'lazy': True}]:
+            generated = apache_log_parser.Parser(format_string, engine='generated', **kwargs).parse(sample)
+            generic = apache_log_parser.Parser(format_string, engine='generic', **kwargs).parse(sample)
+            self.assertEqual(generated, generic)
+            self.assertEqual(list(generated), list(generic))
+        self.assertRaises(ValueError, apache_log_parser.Parser, format_string, engine='nonsense')
+
+    def test_profile(self):
+        format_string = "%h %l %u %t \"%r\" %>s %b \"%{User-Agent}i\""
+        sample = '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326 "Mozilla/5.0"'
+        exported = []
+        parser = apache_log_parser.Parser(format_string, profile=True, stats_hook=exported.append, stats_interval=2)
+        results = list(parser.parse_stream([sample, 'garbage', sample], on_error='skip'))
+        self.assertEqual(results, [apache_log_parser.Parser(format_string).parse(sample)] * 2)
+
+        self.assertEqual(len(exported), 1)
+        stats = exported[0]
+        self.assertEqual(stats['name'], format_string)
+        self.assertEqual(stats['match_failures'], 1)
+        self.assertEqual(list(stats['stages']), ['line_regex', 'build', 'time_received', 'request_first_line', 'request_header_user_agent'])
+        self.assertEqual([stage['calls'] for stage in stats['stages'].values()], [2, 1, 1, 1, 1])
+        self.assertTrue(all(stage['seconds'] > 0 for stage in stats['stages'].values()))
+        # Exporting resets the counts, so these are for the last line
+        self.assertEqual(parser.stats()['stages']['line_regex']['calls'], 1)
+
+        parser.parse_bytes(sample.encode('utf-8'))
+        self.assertEqual(parser.stats(reset=True)['stages']['build']['calls'], 2)
+        self.assertEqual(parser.stats()['stages']['build']['calls'], 0)
+
+        lazy = apache_log_parser.Parser(format_string, lazy=True, profile=True)
+        result = lazy.parse(sample)
+        self.assertEqual(lazy.stats()['stages']['request_header_user_agent']['calls'], 0)
+        result['request_header_user_agent__is_mobile']
+        self.assertEqual(lazy.stats()['stages']['request_header_user_agent']['calls'], 1)
+
+        self.assertRaises(ValueError, apache_log_parser.Parser(format_string).stats)
+
+    def test_filters(self):
+        format_string = "%h %l %u %t \"%r\" %>s %b"
+        lines = [
+            '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326',
+            '127.0.0.2 - - [10/Oct/2000:13:55:37 -0700] "POST /form HTTP/1.0" 503 -',
+            '10.0.0.1 - - [10/Oct/2000:13:55:38 -0700] "GET /missing HTTP/1.0" 404 12',
+            '10.0.0.2 - - [10/Oct/2000:13:55:39 -0700] "GET /broken HTTP/1.0" 500 12',
+            'garbage',
+        ]
+        full = apache_log_parser.Parser(format_string)
+        results = [full.parse(line) for line in lines[:4]]
+        start = datetime.datetime(2000, 10, 10, 20, 55, 37)
+        for filters, expected in [
+                ({'status': apache_log_parser.Range(500, 599)}, [1, 3]),
+                ({'status': '404'}, [2]),
+                ({'status': ['200', '404'], 'remote_host': apache_log_parser.Prefix('10.')}, [2]),
+                ({'request_first_line': apache_log_parser.Prefix('POST ', 'PUT ')}, [1]),
+                ({'response_bytes_clf': apache_log_parser.Range(high=100)}, [2, 3]),
+                ({'time_received': apache_log_parser.TimeRange(start, start + datetime.timedelta(seconds=2))}, [1, 2]),
+                ({'time_received': apache_log_parser.TimeRange(end=971211337)}, [0])]:
+            parser = apache_log_parser.Parser(format_string, filters=filters)
+            expected = [results[i] for i in expected]
+            self.assertEqual(list(parser.parse_stream(lines, on_error='skip')), expected)
+            self.assertEqual(list(parser.parse_mmap("\n".join(lines).encode('utf-8'), on_error='skip')), expected)
+            self.assertEqual([result for result in map(parser.parse, lines[:4]) if result is not None], expected)
+
+        # The line regex isn't run when the status isn't in the line, so
+        # those lines are skipped, even the garbage
+        parser = apache_log_parser.Parser(format_string, filters={'status': apache_log_parser.Range(500, 599)}, profile=True)
+        self.assertEqual(len(list(parser.parse_stream(lines, on_error='raise'))), 2)
+        self.assertEqual((parser.lines_matched, parser.lines_filtered, parser.lines_skipped, parser.lines_unmatched), (2, 0, 3, 0))
+        self.assertEqual(parser.stats()['stages']['line_regex']['calls'], 2)
+        self.assertEqual(parser.parse('garbage'), None)
+        parser = apache_log_parser.Parser(format_string, filters={'time_received': apache_log_parser.TimeRange(end=971211337)})
+        self.assertRaises(apache_log_parser.LineDoesntMatchException, list, parser.parse_stream(lines))
+        self.assertEqual((parser.lines_matched, parser.lines_filtered, parser.lines_skipped, parser.lines_unmatched), (1, 3, 0, 1))
+
+        # Fields that are only needed for a filter are captured, but not returned
+        parser = apache_log_parser.Parser(format_string, fields=['request_url'], filters={'status': '503'})
+        self.assertEqual(list(parser.parse_stream(lines, on_error='skip')), [{'request_url': '/form'}])
+        self.assertEqual(parser.parse_batch(lines[:4]), {'request_first_line': ['POST /form HTTP/1.0']})
+
+        self.assertRaises(ValueError, apache_log_parser.Parser, format_string, filters={'request_url': '/form'})
+        self.assertTrue(apache_log_parser.get_parser(format_string, filters={'status': '404'}) is
+                        apache_log_parser.get_parser(format_string, filters={'status': apache_log_parser.Equals('404')}))
+
+    def test_slots_records(self):
+        format_string = "%v %h %l %u %t \"%r\" %>s %b \"%{User-Agent}i\" \"%{X-Forwarded-For}i\""
+        lines = [
+            'example.com 127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326 "Mozilla/5.0" "-"',
+            'example.com 127.0.0.2 - - [10/Oct/2000:13:55:37 -0700] "GET /other HTTP/1.0" 200 12 "Mozilla/5.0" "10.0.0.1"',
+        ]
+        for kwargs in [{}, {'fields': ['status', 'request_url', 'time_received_isoformat']}]:
+            expected = [apache_log_parser.Parser(format_string, **kwargs).parse(line) for line in lines]
+            parser = apache_log_parser.Parser(format_string, record='slots', **kwargs)
+            records = list(parser.parse_stream(lines))
+            self.assertEqual(records, expected)
+            self.assertEqual([list(record) for record in records], [list(result) for result in expected])
+            self.assertEqual(list(parser.parse_mmap("\n".join(lines).encode('utf-8'))), expected)
+            self.assertEqual(pickle.loads(pickle.dumps(records[0])), expected[0])
+
+        record = records[0]
+        self.assertTrue(isinstance(record, apache_log_parser.LogRecord))
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertEqual((record.status, record['request_url'], record.get('nonsense')), ('200', '/apache_pb.gif', None))
+        self.assertRaises(KeyError, lambda: record['nonsense'])
+
+        records = list(apache_log_parser.Parser(format_string, record='slots').parse_stream(lines))
+        self.assertEqual(records[1]['request_header_x_forwarded_for'], '10.0.0.1')
+        # Low cardinality values are shared
+        self.assertTrue(records[0].server_name is records[1].server_name)
+        self.assertTrue(records[0].request_method is records[1].request_method)
+
+        self.assertRaises(ValueError, apache_log_parser.Parser, format_string, record='nonsense')
+        self.assertRaises(ValueError, apache_log_parser.Parser, format_string, record='slots', lazy=True)
+
+    def test_multi_parser(self):
+        common = "%h %l %u %t \"%r\" %>s %b"
+        combined = "%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\""
+        vhost = "%v %h <<%P>> %t \"%r\" %>s"
+        lines = [
+            '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326 "http://example.com/" "Mozilla/5.0"',
+            '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326',
+            'example.com 127.0.0.1 <<6113>> [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.1" 404',
+            '127.0.0.2 - - [10/Oct/2000:13:55:37 -0700] "POST /form HTTP/1.0" 503 -',
+        ]
+        line_formats = [combined, common, vhost, common]
+        expected = [apache_log_parser.Parser(format_string).parse(line) for format_string, line in zip(line_formats, lines)]
+
+        parser = apache_log_parser.MultiParser([common, combined, vhost])
+        # The common format matches the start of a combined line, but isn't used for it
+        self.assertEqual(parser.parse_with_format(lines[0]), (combined, expected[0]))
+        self.assertEqual(parser.order, (combined, common, vhost))
+        self.assertEqual(list(parser.parse_stream(lines[1:] + ['garbage'], on_error='skip')), expected[1:])
+        self.assertEqual(parser.order, (common, vhost, combined))
+        self.assertEqual(dict(parser.match_counts), {common: 2, combined: 1, vhost: 1})
+        self.assertEqual(parser.lines_unmatched, 1)
+        self.assertRaises(apache_log_parser.LineDoesntMatchException, parser.parse, 'garbage')
+        # A match of just the start of the line, when no format matches all of it
+        self.assertEqual(parser.parse_with_format(lines[1] + ' "-"'), (common, expected[1]))
+        # Whichever format matched last, the first one given is used for those
+        first, second = "%h \"%r\" %>s", "%h \"%{Referer}i\" %D"
+        parser = apache_log_parser.MultiParser([first, second])
+        for line in ['1.2.3.4 "q" 7 extra', '1.2.3.4 "q" -5', '1.2.3.4 "q" 7 extra', '1.2.3.4 "q" -5']:
+            self.assertEqual(parser.parse_with_format(line)[0], first if line.endswith('extra') else second)
+
+        bad_lines = []
+        self.assertEqual(list(parser.parse_stream(['garbage'], on_error=bad_lines.append)), [])
+        self.assertEqual(bad_lines, ['garbage'])
+
+        parser = apache_log_parser.MultiParser([common, combined, vhost], adaptive=False, record='slots', filters={'status': '200'})
+        self.assertEqual(list(parser.parse_stream(lines)), expected[:2])
+        self.assertEqual(parser.order, (common, combined, vhost))
+        # The other two don't have '" 200' in them, so they're skipped before matching
+        self.assertEqual((parser.lines_filtered, parser.lines_skipped, parser.lines_unmatched), (0, 2, 0))
+        # This one does, in the referer, so it's matched and filtered out as a combined line
+        self.assertEqual(parser.parse_with_format('127.0.0.1 - - [10/Oct/2000:13:55:37 -0700] "GET / HTTP/1.0" 404 1 " 200 x" "UA"'), (combined, None))
+        self.assertEqual((parser.lines_filtered, dict(parser.match_counts)[combined]), (1, 2))
+
+        # Matched through each format's Parser, which may be profiled
+        parser = apache_log_parser.MultiParser([common, vhost], profile=True)
+        self.assertEqual(len(list(parser.parse_stream(lines[1:]))), 3)
+        self.assertTrue(sum(p.stats()['stages']['line_regex']['calls'] for p in parser.parsers) >= 3)
+        self.assertRaises(TypeError, list, parser.parse_stream([lines[1].encode('utf-8')]))
+        self.assertRaises(ValueError, apache_log_parser.MultiParser, [common, common])
+
+    def test_follow(self):
+        format_string = "%h %>s %u"
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'access.log')
+        checkpoint_path = os.path.join(tmpdir, 'access.pos')
+
+        def append(data, path=path):
+            with open(path, 'ab') as f:
+                f.write(data)
+
+        def hosts(results):
+            return [result['remote_host'] for result in results]
+
+        append(b"1.1.1.1 200 -\n")
+        follower = apache_log_parser.follow(path, format_string, checkpoint_path=checkpoint_path)
+        self.assertEqual(follower.poll(), [])
+        append(b"2.2.2.2 200 -\n3.3.3.3 404 -\n4.4.4.4 ")
+        self.assertEqual(hosts(follower.poll()), ['2.2.2.2', '3.3.3.3'])
+        self.assertEqual(follower.checkpoint['offset'], len(b"1.1.1.1 200 -\n2.2.2.2 200 -\n3.3.3.3 404 -\n"))
+        append(b"200 -\n")
+        self.assertEqual(hosts(follower.poll()), ['4.4.4.4'])
+        follower.close()
+
+        # Restarting carries on from the checkpoint, even after a rotation
+        # The old file's last line has no newline
+        append(b"5.5.5.5 200 -\n6.6.6.6 200 -")
+        os.rename(path, path + '.1')
+        append(b"7.7.7.7 200 -\n")
+        follower = apache_log_parser.follow(path, format_string, checkpoint_path=checkpoint_path)
+        self.assertEqual(hosts(follower.poll()), ['5.5.5.5', '6.6.6.6', '7.7.7.7'])
+
+        # Rotated while following, with the old file written to after the rename
+        os.rename(path, path + '.1')
+        append(b"8.8.8.8 200 -\n", path + '.1')
+        self.assertEqual(hosts(follower.poll()), ['8.8.8.8'])
+        append(b"9.9.9.9 200 -\n")
+        self.assertEqual(hosts(follower.poll()), ['9.9.9.9'])
+        self.assertEqual(follower.rotations, 2)
+
+        # Truncated
+        open(path, 'wb').close()
+        self.assertEqual(follower.poll(), [])
+        append(b"10.10.10.10 200 -\n")
+        self.assertEqual(hosts(follower.poll()), ['10.10.10.10'])
+        self.assertEqual(follower.truncations, 1)
+
+        append(b"11.11.11.11 200 -\n")
+        follower.max_idle = 0
+        with follower:
+            self.assertEqual(hosts(follower), ['11.11.11.11'])
+        self.assertEqual(apache_log_parser.tail.load_checkpoint(checkpoint_path), follower.checkpoint)
+
+        # Stopping part way through what's been read leaves the rest to be read next time
+        follower = apache_log_parser.follow(path, format_string, checkpoint_path=checkpoint_path)
+        append(b"".join(b"12.0.0." + str(i).encode('ascii') + b" 200 -\n" for i in range(10)))
+        for result in follower:
+            break
+        self.assertEqual(result['remote_host'], '12.0.0.0')
+        append(b"13.13.13.13 200 -\n")
+        self.assertEqual(hosts(follower.poll()), ['12.0.0.{}'.format(i) for i in range(1, 10)] + ['13.13.13.13'])
+        self.assertEqual(follower.checkpoint['offset'], os.path.getsize(path))
+        follower.close()
+
+    @unittest.skipIf(sys.version_info < (3, 5), "needs async/await")
+    def test_follow_async(self):
+        import asyncio
+        from apache_log_parser.aio import follow_async
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'access.log')
+        with open(path, 'wb') as f:
+            f.write(b"1.1.1.1 200 -\n2.2.2.2 200 -\n")
+
+        async def read_all():
+            results = []
+            async with follow_async(path, "%h %>s %u", from_start=True, poll_interval=0.01, max_idle=0.05) as lines:
+                async for result in lines:
+                    results.append(result['remote_host'])
+                    if len(results) == 2:
+                        with open(path, 'ab') as f:
+                            f.write(b"3.3.3.3 200 -\n")
+            return results
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual(loop.run_until_complete(read_all()), ['1.1.1.1', '2.2.2.2', '3.3.3.3'])
+
+    @unittest.skipIf(sys.version_info < (3, 5), "needs async/await")
+    def test_follow_async_backlog(self):
+        import asyncio
+        from apache_log_parser import aio
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'access.log')
+        with open(path, 'wb') as f:
+            f.write(b"".join("1.1.1.{} 200 -\n".format(i).encode('ascii') for i in range(10)))
+        self.addCleanup(setattr, aio, 'YIELD_EVERY', aio.YIELD_EVERY)
+        aio.YIELD_EVERY = 3
+
+        events = []
+
+        async def ticker():
+            while True:
+                events.append('tick')
+                await asyncio.sleep(0)
+
+        async def read_all():
+            tick = asyncio.ensure_future(ticker())
+            # The ticker task gets its first turn here
+            await asyncio.sleep(0)
+            with aio.follow_async(path, "%h %>s %u", from_start=True, poll_interval=0.01, max_idle=0.05) as lines:
+                # __anext__ works without __aiter__ having been called
+                while True:
+                    try:
+                        result = await lines.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    events.append(result['remote_host'])
+            tick.cancel()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop.run_until_complete(read_all())
+        hosts = [event for event in events if event != 'tick']
+        self.assertEqual(hosts, ['1.1.1.{}'.format(i) for i in range(10)])
+        # Other tasks ran while the backlog of 10 lines was being read, not only once it was done
+        self.assertEqual(events[:6], ['tick', '1.1.1.0', '1.1.1.1', 'tick', '1.1.1.2', '1.1.1.3'])
+
+
+class GenericEngineTestCase(ApacheLogParserTestCase):
+    """Run all the tests again with the generic engine"""
+
+    def setUp(self):
+        self.default_engine = apache_log_parser.DEFAULT_ENGINE
+        apache_log_parser.DEFAULT_ENGINE = 'generic'
+
+    def tearDown(self):
+        apache_log_parser.DEFAULT_ENGINE = self.default_engine
 
 
 if __name__ == '__main__':
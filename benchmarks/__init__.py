@@ -0,0 +1,4 @@
+"""
+Benchmarks for apache_log_parser. Run them from the top of the source tree,
+e.g. ``python -m benchmarks.time_decoding``.
+"""
@@ -0,0 +1,160 @@
+"""
+Deterministic synthetic log lines for any format string, with a realistic
+mix of User-Agents, URLs, statuses and timestamps, and some garbage lines.
+
+    >>> from benchmarks.generator import LogGenerator, COMBINED
+    >>> lines = list(LogGenerator(COMBINED, seed=1).lines(1000))
+"""
+import random
+from datetime import datetime, timedelta
+
+import apache_log_parser
+
+COMMON = "%h %l %u %t \"%r\" %>s %b"
+COMBINED = "%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\""
+VHOST_COMBINED = "%v:%p %h %l %u %t \"%r\" %>s %O \"%{Referer}i\" \"%{User-Agent}i\""
+# The formats from test_pr8, with %{...}p, %{...}n, %{...}x & %{...}e fields
+SSL_EXTENDED = "%h %{remote}p %v %{local}p %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\" %P %D %{number}n %{SSL_PROTOCOL}x %{SSL_CIPHER}x %k %{UNIQUE_ID}e "
+NOTES_EXTENDED = "%A %V %p %P %a \"%r\" \"%{main_call}n\" %{some_time}t %b %>s %D %{UNIQUE_ID}e "
+
+FORMATS = {
+    'common': COMMON,
+    'combined': COMBINED,
+    'vhost_combined': VHOST_COMBINED,
+    'ssl_extended': SSL_EXTENDED,
+    'notes_extended': NOTES_EXTENDED,
+}
+
+# (weight, value)
+USER_AGENTS = [
+    (30, "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36"),
+    (15, "Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2062.120 Safari/537.36"),
+    (10, "Mozilla/5.0 (X11; Linux x86_64; rv:29.0) Gecko/20100101 Firefox/29.0"),
+    (10, "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_4) AppleWebKit/603.1.30 (KHTML, like Gecko) Version/10.1 Safari/603.1.30"),
+    (10, "Mozilla/5.0 (iPhone; CPU iPhone OS 10_3_1 like Mac OS X) AppleWebKit/603.1.30 (KHTML, like Gecko) Version/10.0 Mobile/14E304 Safari/602.1"),
+    (8, "Mozilla/5.0 (Linux; Android 7.0; SM-G930V Build/NRD90M) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.125 Mobile Safari/537.36"),
+    (6, "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"),
+    (4, "Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)"),
+    (3, "curl/7.35.0"),
+    (2, "python-requests/2.18.1"),
+    (1, "-"),
+    (1, "Mozilla/5.0 zgrab/0.x"),
+]
+
+METHODS = [(85, "GET"), (10, "POST"), (3, "HEAD"), (1, "OPTIONS"), (1, "PUT")]
+
+STATUSES = [(70, "200"), (10, "304"), (6, "301"), (5, "302"), (5, "404"), (2, "500"), (1, "403"), (1, "503")]
+
+PATHS = ["/", "/index.html", "/favicon.ico", "/robots.txt", "/static/css/site.css", "/static/js/app.js",
+         "/images/logo.png", "/blog/", "/blog/{0}/", "/products/{0}", "/search", "/api/v1/items/{0}",
+         "/wp-login.php", "/cgi-bin/test.cgi"]
+
+REFERERS = [(50, "-"), (20, "https://www.google.com/"), (20, "https://example.com/{0}"), (10, "https://t.co/{0}")]
+
+VHOSTS = ["example.com", "www.example.com", "static.example.com", "api.example.com"]
+
+# Lines which don't match any format
+GARBAGE = [
+    "",
+    "-",
+    "\\x16\\x03\\x01\\x02\\x00\\x01\\x00\\x01\\xfc\\x03\\x03",
+    "GET / HTTP/1.1",
+    "127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] \"GET /truncated",
+]
+
+def _weighted(choices):
+    values = []
+    for weight, value in choices:
+        values.extend([value] * weight)
+    return values
+
+class LogGenerator(object):
+    """
+    Makes log lines in format_string. The same seed always gives the same
+    lines. ``garbage_rate`` is the fraction of lines which are garbage, and
+    ``lines_per_second`` how many lines share each timestamp, on average.
+    """
+
+    def __init__(self, format_string, seed=0, garbage_rate=0.01, lines_per_second=20,
+                 start=datetime(2015, 3, 8, 18, 6, 58)):
+        self.format_string = format_string
+        self.random = random.Random(seed)
+        self.garbage_rate = garbage_rate
+        self.lines_per_second = lines_per_second
+        self.now = start
+        self.user_agents = _weighted(USER_AGENTS)
+        self.methods = _weighted(METHODS)
+        self.statuses = _weighted(STATUSES)
+        self.referers = _weighted(REFERERS)
+        self.fields, self.trailing = apache_log_parser.format_fields(format_string)
+
+    def lines(self, count):
+        """Yield count lines, without newlines"""
+        for i in range(count):
+            yield self.line()
+
+    def line(self):
+        rand = self.random
+        if rand.random() < 1.0 / self.lines_per_second:
+            self.now += timedelta(seconds=1)
+        if rand.random() < self.garbage_rate:
+            return rand.choice(GARBAGE)
+        parts = []
+        for raw, directive, name, log_part_regex, values_func in self.fields:
+            parts.append(raw)
+            parts.append(self.value(name))
+        parts.append(self.trailing)
+        return "".join(parts)
+
+    def ip(self):
+        rand = self.random
+        if rand.random() < 0.05:
+            return "2001:db8:{0:x}::{1:x}".format(rand.randrange(0x10000), rand.randrange(0x10000))
+        return "{0}.{1}.{2}.{3}".format(rand.randrange(1, 224), rand.randrange(256), rand.randrange(256), rand.randrange(1, 255))
+
+    def request_first_line(self):
+        rand = self.random
+        path = rand.choice(PATHS).format(rand.randrange(1000))
+        if rand.random() < 0.2:
+            path += "?q={0}&page={1}".format(rand.randrange(100000), rand.randrange(10))
+        return "{0} {1} HTTP/1.{2}".format(rand.choice(self.methods), path, rand.choice("01"))
+
+    def value(self, name):
+        rand = self.random
+        if name in ('remote_host', 'remote_ip', 'local_ip'):
+            return self.ip()
+        elif name == 'time_received':
+            return self.now.strftime("[%d/%b/%Y:%H:%M:%S +0000]")
+        elif name.startswith('time_'):
+            if name == 'time_us':
+                return str(rand.randrange(100, 2000000))
+            return self.now.strftime("%Y%m%d%H%M%S")
+        elif name == 'request_first_line':
+            return self.request_first_line()
+        elif name == 'status':
+            return rand.choice(self.statuses)
+        elif name in ('response_bytes_clf', 'response_bytes', 'bytes_tx', 'bytes_rx'):
+            if name == 'response_bytes_clf' and rand.random() < 0.1:
+                return "-"
+            return str(int(rand.expovariate(1.0 / 20000)))
+        elif name == 'request_header_user_agent':
+            return rand.choice(self.user_agents)
+        elif name == 'request_header_referer':
+            return rand.choice(self.referers).format(rand.randrange(1000))
+        elif name in ('server_name', 'server_name2'):
+            return rand.choice(VHOSTS)
+        elif name.startswith('server_port'):
+            return rand.choice(("80", "443")) if name in ('server_port', 'server_port_local') else str(rand.randrange(1024, 65536))
+        elif name in ('pid', 'num_keepalives'):
+            return str(rand.randrange(1, 32768) if name == 'pid' else rand.randrange(5))
+        elif name == 'remote_user':
+            return "-" if rand.random() < 0.95 else rand.choice(("frank", "alice", "bob"))
+        elif name == 'env_unique_id':
+            return "".join(rand.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789@-") for i in range(24))
+        elif name == 'extension_ssl_protocol':
+            return rand.choice(("TLSv1.2", "TLSv1.2", "TLSv1.1", "TLSv1"))
+        elif name == 'extension_ssl_cipher':
+            return rand.choice(("ECDHE-RSA-AES128-GCM-SHA256", "ECDHE-RSA-AES256-SHA384", "AES128-SHA"))
+        elif name.startswith('note_'):
+            return rand.choice(("0", "1", "-"))
+        return "-"
@@ -0,0 +1,62 @@
+"""
+Benchmark of parse_file_parallel against a single Parser.parse_file, and
+of parse_file_parallel_batches against a single Parser.parse_batch, with
+1 up to cpu_count() workers, on a synthetic combined format log file.
+
+    python -m benchmarks.parallel [lines]
+"""
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import apache_log_parser
+from benchmarks.generator import COMBINED, LogGenerator
+
+def write_log(path, lines, seed=0):
+    with open(path, 'w') as f:
+        for line in LogGenerator(COMBINED, seed=seed, garbage_rate=0).lines(lines):
+            f.write(line + "\n")
+
+def timed(results):
+    start = time.time()
+    count = sum(1 for _ in results)
+    return count, time.time() - start
+
+def timed_batches(batches):
+    start = time.time()
+    count = sum(len(batch['remote_host']) for batch in batches)
+    return count, time.time() - start
+
+def report(label, count, took, size, single):
+    print("{0:>23}: {1:>10.0f} lines/s {2:>6.1f} MB/s, {3:.2f}x".format(label, count / took, size / took / 1e6, single / took))
+
+def main(lines=200000):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'access.log')
+        write_log(path, lines)
+        size = os.path.getsize(path)
+
+        parser = apache_log_parser.Parser(COMBINED)
+        count, single = timed(parser.parse_file(path))
+        report("single process", count, single, size, single)
+        with open(path) as f:
+            count, single_batch = timed_batches(parser.parse_batches(f))
+        report("single process, batches", count, single_batch, size, single_batch)
+
+        chunk_size = max(size // (4 * multiprocessing.cpu_count()), 1024 * 1024)
+        for workers in range(1, multiprocessing.cpu_count() + 1):
+            for ordered in (True, False):
+                label = "{0:>2} workers, {1}".format(workers, "ordered" if ordered else "unordered")
+                count, took = timed(apache_log_parser.parse_file_parallel(path, COMBINED, workers=workers, ordered=ordered, chunk_size=chunk_size))
+                report(label, count, took, size, single)
+            count, took = timed_batches(apache_log_parser.parse_file_parallel_batches(path, COMBINED, workers=workers, chunk_size=chunk_size))
+            report("{0:>2} workers, batches".format(workers), count, took, size, single_batch)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,64 @@
+"""
+Time the line regex and request line splitting on pathological input of
+increasing size, with the delimiter-aware regex and with the old one where
+every field is ".*?". The time per line should grow linearly with the line
+length with the current regex.
+
+    python -m benchmarks.regex_worst_case
+"""
+import re
+import timeit
+
+import apache_log_parser
+
+# Combined log format, with the time taken at the end
+COMBINED_D = "%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\" %D"
+
+def old_parser(format_string):
+    """A Parser with the regex as it was before tighten_field_regex"""
+    tighten_field_regex = apache_log_parser.tighten_field_regex
+    apache_log_parser.tighten_field_regex = lambda log_part_regex, directive, following, at_end=False: log_part_regex
+    # format_fields remembers the tightened fields for each format string
+    apache_log_parser._format_fields_cache.clear()
+    try:
+        return apache_log_parser.Parser(format_string)
+    finally:
+        apache_log_parser.tighten_field_regex = tighten_field_regex
+        apache_log_parser._format_fields_cache.clear()
+
+def old_extra_request_from_first_line(matched_strings):
+    first_line = matched_strings['request_first_line']
+    return re.match("^(?P<method>GET|HEAD|POST|OPTIONS|PUT|CONNECT|PATCH|PROPFIND|DELETE)\\s?(?P<url>.{,10000}?)(\\s+HTTP/(?P<http_ver>1.[01]))?$", first_line)
+
+def quotes_in_request(size):
+    """
+    A truncated line which doesn't match, with lots of '" 2 "' in the request,
+    each of which the old regex tries as the end of %r, %>s & %b
+    """
+    return '127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET /' + '" 2 "' * (size // 5)
+
+def spaces_in_request(size):
+    return 'GET /' + ' ' * size + 'x'
+
+def per_line(func, arg, number=10, repeat=3):
+    return min(timeit.repeat(lambda: func(arg), number=number, repeat=repeat)) / number
+
+def main(sizes=(125, 250, 500, 1000, 2000)):
+    new, old = apache_log_parser.Parser(COMBINED_D), old_parser(COMBINED_D)
+    assert new.log_line_regex.pattern != old.log_line_regex.pattern
+    cases = [
+        ("line regex, quotes in the request", quotes_in_request,
+         new.log_line_regex.match, old.log_line_regex.match),
+        ("request line, runs of spaces", spaces_in_request,
+         lambda line: apache_log_parser.extra_request_from_first_line({'request_first_line': line}),
+         lambda line: old_extra_request_from_first_line({'request_first_line': line})),
+    ]
+    for label, make_input, new_func, old_func in cases:
+        print(label)
+        for size in sizes:
+            line = make_input(size)
+            new_time, old_time = per_line(new_func, line), per_line(old_func, line, number=1, repeat=1)
+            print("  {0:>6} chars: {1:>10.1f} us/line (old regex {2:>10.1f} us/line)".format(len(line), new_time * 1e6, old_time * 1e6))
+
+if __name__ == '__main__':
+    main()
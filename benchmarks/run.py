@@ -0,0 +1,162 @@
+"""
+Benchmark suite: parses synthetic logs (see benchmarks.generator) in each
+format, and times the whole line parse, the line regex on its own, and each
+post processor. Reports lines/s and bytes/s, and can save the results as
+JSON and compare them with an earlier run.
+
+    python -m benchmarks.run --output before.json
+    ... change things ...
+    python -m benchmarks.run --output after.json --compare before.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+from functools import partial
+from itertools import count
+
+import apache_log_parser
+from apache_log_parser._version import __version__
+from benchmarks.generator import FORMATS, LogGenerator
+
+# Lines given to the parse_user_agent_uncached stage. Each is about 1,000
+# times slower than a cache hit, so it's a sample rather than every line.
+UNCACHED_SAMPLE = 500
+
+_unique_suffixes = count()
+
+def _unique(values):
+    """
+    The first UNCACHED_SAMPLE values, each with a suffix that's never been used
+    before, so that neither our UserAgentCache nor ua-parser's own cache has seen
+    them, as for a UA that's new.
+    """
+    return ["{0} bench/{1}".format(value, next(_unique_suffixes)) for value in values[:UNCACHED_SAMPLE]]
+
+def _same(values):
+    return values
+
+# Stage name, the field it's given, a function which returns the post
+# processor with new, empty caches, as a new Parser would have, and a function
+# which returns the values for one timed run. The generator only uses a few
+# user agents, so parse_user_agent is mostly cache hits, and
+# parse_user_agent_uncached is the cost of parsing a UA that's new.
+POST_PROCESSORS = [
+    ('parse_user_agent', 'request_header_user_agent',
+     lambda: partial(apache_log_parser.parse_user_agent, cache=apache_log_parser.UserAgentCache()), _same),
+    ('parse_user_agent_uncached', 'request_header_user_agent',
+     lambda: partial(apache_log_parser.parse_user_agent, cache=None), _unique),
+    ('format_time', 'time_received',
+     lambda: partial(apache_log_parser.format_time, cache=apache_log_parser.TimeCache()), _same),
+    ('extra_request_from_first_line', 'request_first_line',
+     lambda: apache_log_parser.extra_request_from_first_line, _same),
+]
+
+def best_time(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def rates(seconds, count, size):
+    return {'seconds': seconds, 'lines': count, 'bytes': size,
+            'lines_per_sec': count / seconds, 'bytes_per_sec': size / seconds}
+
+def bench_format(format_string, lines, repeat):
+    """Return the rates for each stage, for parsing lines in format_string"""
+    size = sum(len(line) + 1 for line in lines)
+    results = {}
+
+    def parse():
+        # A new parser each time, so that its caches start empty
+        parser = apache_log_parser.Parser(format_string)
+        for _ in parser.parse_stream(lines, on_error='skip'):
+            pass
+    results['parse'] = rates(best_time(parse, repeat), len(lines), size)
+
+    match = apache_log_parser.Parser(format_string).log_line_regex.match
+    def line_regex():
+        for line in lines:
+            match(line)
+    results['line_regex'] = rates(best_time(line_regex, repeat), len(lines), size)
+
+    parser = apache_log_parser.Parser(format_string)
+    matches = [m for m in (match(line) for line in lines) if m is not None]
+    for stage, name, make_post_processor, make_values in POST_PROCESSORS:
+        if name not in parser.functions_to_parse:
+            continue
+        all_values = [m.group(name) for m in matches]
+        timings = []
+        for _ in range(repeat):
+            # New values for each run, if make_values makes them unique
+            values = make_values(all_values)
+            post_processor = make_post_processor()
+            start = timeit.default_timer()
+            for value in values:
+                post_processor({name: value})
+            timings.append(timeit.default_timer() - start)
+        results[stage] = rates(min(timings), len(values), sum(len(v) for v in values))
+
+    return results
+
+def run(line_count, seed, repeat, formats):
+    results = {}
+    for name in formats:
+        format_string = FORMATS[name]
+        lines = list(LogGenerator(format_string, seed=seed).lines(line_count))
+        results[name] = bench_format(format_string, lines, repeat)
+    return {
+        'meta': {
+            'version': __version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'lines': line_count,
+            'seed': seed,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+def report(run_results, baseline=None, threshold=0.1):
+    """Print the results, compared to the baseline if given. Returns the regressions"""
+    regressions = []
+    for format_name, stages in sorted(run_results['results'].items()):
+        print(format_name)
+        for stage, result in sorted(stages.items()):
+            line = "  {0:<32} {1:>12,.0f} lines/s {2:>8.2f} MB/s".format(stage, result['lines_per_sec'], result['bytes_per_sec'] / 1e6)
+            old = (baseline or {}).get('results', {}).get(format_name, {}).get(stage)
+            if old is not None:
+                change = result['lines_per_sec'] / old['lines_per_sec']
+                line += "  {0:>6.2f}x".format(change)
+                if change < 1 - threshold:
+                    line += "  REGRESSION"
+                    regressions.append((format_name, stage, change))
+            print(line)
+    return regressions
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument("--lines", type=int, default=20000, help="lines per format (default: %(default)s)")
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument("--repeat", type=int, default=3, help="time each stage this many times, and keep the best")
+    argparser.add_argument("--format", dest="formats", action="append", choices=sorted(FORMATS),
+                           help="only benchmark this format (may be given more than once)")
+    argparser.add_argument("--output", help="save the results as JSON to this file")
+    argparser.add_argument("--compare", help="compare with the results in this JSON file")
+    argparser.add_argument("--threshold", type=float, default=0.1,
+                           help="report a regression if lines/s drops by more than this fraction (default: %(default)s)")
+    args = argparser.parse_args(argv)
+
+    run_results = run(args.lines, args.seed, args.repeat, args.formats or sorted(FORMATS))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = report(run_results, baseline, args.threshold)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run_results, f, indent=2, sort_keys=True)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
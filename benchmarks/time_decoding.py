@@ -0,0 +1,47 @@
+"""
+Microbenchmark of %t decoding (format_time) with and without a TimeCache, on
+timestamps in log (sorted) order and shuffled.
+"""
+import random
+import timeit
+from datetime import datetime, timedelta
+
+import apache_log_parser
+
+def make_timestamps(count, lines_per_second=50, window=1000, seed=0):
+    """
+    Return ``count`` timestamps in order, and the same timestamps shuffled
+    within windows of ``window`` lines, like logs written by several workers
+    """
+    start = datetime(2015, 3, 8, 18, 6, 58)
+    timestamps = []
+    for i in range(count):
+        when = start + timedelta(seconds=i // lines_per_second)
+        timestamps.append(when.strftime("[%d/%b/%Y:%H:%M:%S -0400]"))
+    rand = random.Random(seed)
+    shuffled = []
+    for i in range(0, count, window):
+        chunk = timestamps[i:i+window]
+        rand.shuffle(chunk)
+        shuffled.extend(chunk)
+    return timestamps, shuffled
+
+def run(timestamps, cache, repeat=5):
+    matched = [{'time_received': t} for t in timestamps]
+    def decode():
+        if cache is not None:
+            cache.clear()
+        for m in matched:
+            apache_log_parser.format_time(m, cache)
+    return min(timeit.repeat(decode, number=1, repeat=repeat))
+
+def main(count=100000):
+    sorted_timestamps, shuffled_timestamps = make_timestamps(count)
+    for label, timestamps in (("sorted", sorted_timestamps), ("unsorted", shuffled_timestamps)):
+        uncached = run(timestamps, None)
+        cached = run(timestamps, apache_log_parser.TimeCache())
+        print("{0:>9}: uncached {1:>10.0f} lines/s, cached {2:>10.0f} lines/s, {3:.1f}x".format(
+            label, count / uncached, count / cached, uncached / cached))
+
+if __name__ == '__main__':
+    main()
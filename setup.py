@@ -12,6 +12,9 @@ setup(name="apache-log-parser",
       install_requires = [
         'user-agents',
       ],
+      extras_require = {
+        'numpy': ['numpy'],
+      },
       license = 'GPLv3+',
       description = "Parse lines from an apache log file",
       test_suite='apache_log_parser.tests',